@@ -3,23 +3,9 @@
 # Standard library imports
 import logging
 import os
-import shutil
 import sys
 import types
 
-# Python 2/3 compatibility imports
-try:
-    from StringIO import StringIO
-except ImportError:
-    from io import StringIO
-
-# Third-party imports
-try:
-    from filelock import FileLock
-    HAS_FILELOCK = True
-except ImportError:
-    HAS_FILELOCK = False
-
 import behave
 from behave.runner import ModelRunner
 
@@ -28,8 +14,10 @@ from behavex import environment as bhx_benv
 from behavex.conf_mgr import get_param
 
 # Local behavex-images imports
+from behavex_images import image_attachments
 from behavex_images.image_attachments import AttachmentsCondition
-from behavex_images.utils import report_utils
+from behavex_images.utils import executors, log_capture, metrics, provisioning, report_utils, run_index
+from behavex_images.utils.provisioning import SupportFilesMode
 
 # Configure filelock logging to reduce verbosity
 logging.getLogger("filelock").setLevel(logging.INFO)
@@ -53,115 +41,98 @@ def extend_behave_hooks():
     behavex_images_env = sys.modules[__name__]
     is_dry_run = get_param('dry_run')
 
-    def run_hook(self, name, context=None, *args):
-
-        # Behave version compatibility: handle different hook signatures
-        # Behave 1.2.6: run_hook(name, context, *args) where context is the actual context
+    # Resolution of the context and the hook target, based on the hook signature of each behave version
+    if BEHAVE_VERSION >= (1, 3):
         # Behave 1.3.0: run_hook(name, hook_target, *args) where hook_target is Scenario/Step/Feature/etc.
+        def resolve_all_hook(self, context, args):
+            # For before_all/after_all: context=None, get context from self
+            return getattr(self, 'context', None) or context, None
+
+        def resolve_hook(self, context, args):
+            # For other hooks: context parameter is the hook target
+            actual_context = getattr(self, 'context', None)
+            # If we can't get context from self, try to find it in args
+            if actual_context is None:
+                actual_context = args[0] if args and hasattr(args[0], 'config') else context
+            return actual_context, context
+    else:
+        # Behave 1.2.6: run_hook(name, context, *args) where context is the actual context
+        def resolve_all_hook(self, context, args):
+            # For before_all/after_all in 1.2.6, there might not be additional args
+            return context if context is not None else _find_context(args), None
+
+        def resolve_hook(self, context, args):
+            # For hooks other than before_all/after_all, hook_target is in args
+            return context if context is not None else _find_context(args), args[0] if args else None
+
+    # The behavex-images hooks are looked up by name when they are called, so they can be patched or reloaded
+    def call_with_context(hook_name):
+        return lambda actual_context, hook_target: getattr(behavex_images_env, hook_name)(actual_context)
+
+    def call_with_target(hook_name, is_valid_target):
+        def call(actual_context, hook_target):
+            # Validate the hook target has the expected attributes
+            if hook_target and is_valid_target(hook_target):
+                getattr(behavex_images_env, hook_name)(actual_context, hook_target)
+        return call
+
+    def is_scenario(scenario):
+        return hasattr(scenario, 'name')
+
+    def is_finished_scenario(scenario):
+        return hasattr(scenario, 'name') and hasattr(scenario, 'status')
+
+    def is_step(step):
+        return hasattr(step, 'name') or hasattr(step, 'step_type')
+
+    # Hook name -> (context resolver, behavex-images hook, metrics stage), built once when the hooks are extended.
+    # Hooks not in this table (e.g. before_feature, after_step, after_feature, before_tag and after_tag) are not
+    # implemented in behavex-images, so they go straight to the original behave hook
+    hook_dispatch_table = {
+        'before_all': (resolve_all_hook, call_with_context('before_all'), 'run_hook.before_all'),
+        'before_scenario': (resolve_hook, call_with_target('before_scenario', is_scenario), 'run_hook.before_scenario'),
+        'before_step': (resolve_hook, call_with_target('before_step', is_step), 'run_hook.before_step'),
+        'after_scenario': (resolve_hook, call_with_target('after_scenario', is_finished_scenario),
+                           'run_hook.after_scenario'),
+        'after_all': (resolve_all_hook, call_with_context('after_all'), 'run_hook.after_all'),
+    }
 
-        actual_context = None
-        hook_target = None
-
+    def run_hook(self, name, context=None, *args):
+        hook_dispatch = hook_dispatch_table.get(name)
+        if hook_dispatch is None:
+            if not is_dry_run:
+                try:
+                    behave_run_hook(self, name, context, *args)
+                except Exception as hook_error:
+                    # Log but don't fail - some hooks might not be implemented in all versions
+                    _log_exception_and_continue(f'behave_run_hook({name})', hook_error)
+            return
+        resolve_context, behavex_images_hook, metrics_stage = hook_dispatch
+        is_before_hook = name.startswith('before_')
         try:
-            if BEHAVE_VERSION >= (1, 3):
-                # Behave 1.3.0+ behavior: context parameter is actually the hook target
-                if name in ('before_all', 'after_all'):
-                    # For before_all/after_all: context=None, get context from self
-                    actual_context = getattr(self, 'context', None) or context
-                else:
-                    # For other hooks: context parameter is the hook target
-                    hook_target = context
-                    actual_context = getattr(self, 'context', None)
-
-                    # If we can't get context from self, try to find it in args
-                    if actual_context is None:
-                        if args and hasattr(args[0], 'config'):
-                            actual_context = args[0]
-                        else:
-                            # Last resort fallback
-                            actual_context = context
-            else:
-                # Behave 1.2.6 behavior: context parameter is the actual context
-                actual_context = context
-                # For hooks other than before_all/after_all, hook_target is in args
-                if name not in ('before_all', 'after_all') and args:
-                    hook_target = args[0]
-                elif name in ('before_all', 'after_all'):
-                    # For before_all/after_all in 1.2.6, there might not be additional args
-                    hook_target = None
-
-                # Additional validation for Behave 1.2.6
-                if actual_context is None and args:
-                    # Sometimes context might be None, try to find it in args
-                    for arg in args:
-                        if hasattr(arg, 'config') or hasattr(arg, 'feature'):
-                            actual_context = arg
-                            break
+            actual_context, hook_target = resolve_context(self, context, args)
 
             # Call the original behave hook first (except for after hooks)
-            if name.startswith('before_') or name in ['before_tag', 'after_tag']:
-                # noinspection PyUnresolvedReferences
-                if not is_dry_run:
-                    try:
-                        behave_run_hook(self, name, context, *args)
-                    except Exception as hook_error:
-                        # Log but don't fail - some hooks might not be implemented in all versions
-                        _log_exception_and_continue(f'behave_run_hook({name}) - before/tag', hook_error)
-
-            # Call BehavEx hooks with proper arguments based on hook type
-            # Only proceed if we have a valid context
-            # NOTE: before_tag and after_tag hooks are not implemented in behavex-images
+            if is_before_hook and not is_dry_run:
+                try:
+                    behave_run_hook(self, name, context, *args)
+                except Exception as hook_error:
+                    # Log but don't fail - some hooks might not be implemented in all versions
+                    _log_exception_and_continue(f'behave_run_hook({name}) - before/tag', hook_error)
+
+            # Call behavex-images hooks, only if we have a valid context
             if actual_context is not None:
-                if name == 'before_all':
-                    behavex_images_env.before_all(actual_context)
-                elif name == 'before_feature':
-                    feature = hook_target
-                    # Validate feature object has expected attributes
-                    if feature and (hasattr(feature, 'name') or hasattr(feature, 'filename')):
-                        behavex_images_env.before_feature(actual_context, feature)
-                elif name == 'before_scenario':
-                    scenario = hook_target
-                    # Validate scenario object has expected attributes
-                    if scenario and hasattr(scenario, 'name'):
-                        behavex_images_env.before_scenario(actual_context, scenario)
-                elif name == 'before_step':
-                    step = hook_target
-                    # Validate step object has expected attributes
-                    if step and (hasattr(step, 'name') or hasattr(step, 'step_type')):
-                        behavex_images_env.before_step(actual_context, step)
-                # elif name == 'before_tag':
-                #     # NOT IMPLEMENTED: before_tag hook is not implemented in behavex-images
-                #     pass
-                # elif name == 'after_tag':
-                #     # NOT IMPLEMENTED: after_tag hook is not implemented in behavex-images
-                #     pass
-                elif name == 'after_step':
-                    step = hook_target
-                    # Validate step object has expected attributes
-                    if step and (hasattr(step, 'name') or hasattr(step, 'step_type')):
-                        behavex_images_env.after_step(actual_context, step)
-                elif name == 'after_scenario':
-                    scenario = hook_target
-                    # Validate scenario object has expected attributes
-                    if scenario and hasattr(scenario, 'name') and hasattr(scenario, 'status'):
-                        behavex_images_env.after_scenario(actual_context, scenario)
-                elif name == 'after_feature':
-                    feature = hook_target
-                    # More lenient validation for after_feature
-                    if feature and (hasattr(feature, 'name') or hasattr(feature, 'filename')):
-                        behavex_images_env.after_feature(actual_context, feature)
-                elif name == 'after_all':
-                    behavex_images_env.after_all(actual_context)
+                hook_started = metrics.start()
+                behavex_images_hook(actual_context, hook_target)
+                metrics.stop(metrics_stage, hook_started)
 
             # Call the original behave hook after for after hooks
-            if name.startswith('after_') and name not in ['after_tag']:
-                # noinspection PyUnresolvedReferences
-                if not is_dry_run:
-                    try:
-                        behave_run_hook(self, name, context, *args)
-                    except Exception as hook_error:
-                        # Log but don't fail - some hooks might not be implemented in all versions
-                        _log_exception_and_continue(f'behave_run_hook({name}) - after', hook_error)
+            if not is_before_hook and not is_dry_run:
+                try:
+                    behave_run_hook(self, name, context, *args)
+                except Exception as hook_error:
+                    # Log but don't fail - some hooks might not be implemented in all versions
+                    _log_exception_and_continue(f'behave_run_hook({name}) - after', hook_error)
 
         except Exception as exception:
             # Log hook errors but don't break execution
@@ -203,7 +174,8 @@ def before_all(context):
     """
     This function is executed before all features are run.
 
-    It initializes the screenshot utilities flag and copies gallery utilities only if needed.
+    It installs the log handler used to capture the image captions, initializes the screenshot utilities flag and
+    copies gallery utilities only if needed.
     If an exception occurs during this process, it is logged and the execution continues.
 
     Parameters:
@@ -219,10 +191,13 @@ def before_all(context):
                                        Exception("Context is None - this may indicate a behave version compatibility issue or test setup problem"))
             return
             
+        # A single log handler is installed in the root logger for the whole execution, routing the log records
+        # to the log capture of the active scenario
+        log_capture.install_routing_handler(bhx_benv._get_log_formatter())
         # Initialize the flag - by default we need screenshot utils unless a formatter is specified
         context.bhximgs_needs_screenshot_utils = not bool(get_param('formatter', None))
         if getattr(context, 'bhximgs_needs_screenshot_utils', False):
-            copy_gallery_utilities()
+            copy_gallery_utilities(getattr(context, 'bhximgs_support_files_mode', SupportFilesMode.COPY))
     except Exception as ex:
         _log_exception_and_continue('before_all (behavex-images)', ex)
 
@@ -247,7 +222,7 @@ def before_scenario(context, scenario):
     """
     This function is executed before each scenario is run.
 
-    It sets up the initial configuration for attaching images to the report. It also adds a new log handler to the logger.
+    It sets up the initial configuration for attaching images to the report. It also starts capturing the scenario log.
 
     Parameters:
     context (object): The context object which contains various attributes used in the function.
@@ -268,17 +243,27 @@ def before_scenario(context, scenario):
         # Note: bhximgs_needs_screenshot_utils is already set in before_all()
         # Setup initial configuration for attaching images and logging
         context.bhximgs_image_hash = None
+        context.bhximgs_image_key = None
+        context.bhximgs_images_index = None
         context.bhximgs_attached_images_idx = 0
         context.bhximgs_attached_images = {}
         context.bhximgs_previous_steps = []
+        context.bhximgs_pending_images = []
         context.bhximgs_image_stream = None
-        context.bhximgs_log_stream = StringIO()
-        context.bhximgs_step_log_handler = logging.StreamHandler(context.bhximgs_log_stream)
+        context.bhximgs_image_extension = None
+        context.bhximgs_image_size = None
+        context.bhximgs_delta_keyframe = None
+        # Log records are kept unformatted, and only formatted when they are used as captions of an attached image
+        context.bhximgs_step_log_handler = log_capture.LogCaptureHandler(
+            *getattr(context, 'bhximgs_log_capture_limits', (log_capture.DEFAULT_MAX_LOG_LINES, log_capture.DEFAULT_MAX_LOG_BYTES))
+        )
         # Initialize the last feature line number
         context.bhximgs_last_feature_line = 0
-        # Adding a new log handler to logger
-        context.bhximgs_step_log_handler.setFormatter(bhx_benv._get_log_formatter())
-        logging.getLogger().addHandler(context.bhximgs_step_log_handler)
+        # The log handler installed in before_all routes the log records to the scenario log capture, and it is only
+        # installed again if it was removed (e.g. by behave's logging capture)
+        if not log_capture.is_routing_handler_installed():
+            log_capture.install_routing_handler()
+        log_capture.start_capture(context.bhximgs_step_log_handler)
         # Set the attached images folder to the scenario log path
         context.bhximgs_attached_images_folder = getattr(context, 'log_path', None)
     except Exception as ex:
@@ -340,7 +325,8 @@ def after_scenario(context, scenario):
     This function is executed after each scenario is run.
 
     If the context indicates that images should be attached to the report:
-    - Always dumps the captured images to disk
+    - Processes the images recorded while deferred processing was enabled
+    - Always dumps the captured images to disk (or encodes them into an animated replay, if enabled)
     - Creates a gallery of these images only if screenshot utilities are needed (i.e. no formatter specified)
 
     Parameters:
@@ -362,24 +348,56 @@ def after_scenario(context, scenario):
                 ((attachments_condition == AttachmentsCondition.ALWAYS) or
                  (attachments_condition == AttachmentsCondition.ONLY_ON_FAILURE and getattr(scenario, 'status', None) in ['failed', 'error']))
         ):
-            # Always dump images to disk - they may be needed by the formatter
-            report_utils.dump_images_to_disk(context)
-            
+            # Images recorded in deferred processing mode are only processed when they will be attached
+            image_attachments.process_pending_images(context)
+            needs_gallery = getattr(context, 'bhximgs_needs_screenshot_utils', False)
+            incremental_gallery = needs_gallery and getattr(context, 'bhximgs_incremental_gallery', False)
+            # The animated replay is not used with formatters, as they reference each image file
+            animated_replay = getattr(context, 'bhximgs_replay_format', None) and not getattr(context, 'bhximgs_formatter', None)
+            if animated_replay:
+                # The images are encoded into a single animated image (with its gallery) by a worker thread
+                dump_result = report_utils.dump_images_to_replay(context, title=getattr(scenario, 'name', 'Scenario'),
+                                                                 with_gallery=needs_gallery)
+            elif incremental_gallery:
+                # Each image is appended to the gallery as soon as it is written to disk
+                dump_result = report_utils.dump_images_to_gallery(context, title=getattr(scenario, 'name', 'Scenario'))
+            else:
+                # Always dump images to disk - they may be needed by the formatter
+                dump_result = report_utils.dump_images_to_disk(context)
+
             # Only create gallery if screenshot utilities are needed
-            if getattr(context, 'bhximgs_needs_screenshot_utils', False):
+            if needs_gallery and not incremental_gallery and not animated_replay:
                 captions = report_utils.get_captions(context)
                 attached_images_folder = getattr(context, 'bhximgs_attached_images_folder', None)
                 if attached_images_folder:
+                    thumbnails = report_utils.create_thumbnails(context, dump_result.written)
                     report_utils.create_gallery(
                         attached_images_folder,
                         title=getattr(scenario, 'name', 'Scenario'),
-                        captions=captions
+                        captions=captions,
+                        images=dump_result.written,
+                        thumbnails=thumbnails
                     )
+            if getattr(context, 'bhximgs_run_index_page_size', None):
+                attached_images = getattr(context, 'bhximgs_attached_images', {})
+                run_index.append_scenario_manifest(
+                    getattr(scenario, 'name', 'Scenario'),
+                    _get_scenario_status(scenario),
+                    dump_result.written,
+                    captions=report_utils.get_captions(context),
+                    hashes={key: attached_images[key].get('hash') for key in attached_images}
+                )
     except Exception as ex:
         _log_exception_and_continue('after_scenario (behavex-images)', ex)
     finally:
         # Safe cleanup - this should always run even if context was None
         if context is not None:
+            # Images pending to be processed are discarded if the scenario images were not attached
+            image_attachments.discard_pending_images(context)
+            # Images spilled to disk are removed if they were not moved to their final location
+            report_utils.remove_spilled_images(context)
+            # The keyframe of delta encoded images is released
+            context.bhximgs_delta_keyframe = None
             log_handler = getattr(context, 'bhximgs_step_log_handler', None)
             if log_handler:
                 close_log_handler(log_handler)
@@ -405,7 +423,8 @@ def after_all(context):
     """
     This function is executed after all features are run.
 
-    Currently, this function does not perform any operations. It can be used to set up any necessary state or perform any configuration that should be done after all features are run.
+    It shuts down the thread pools used to process the attached images in background, creates the run-level
+    image index and writes the metrics summary, if they were enabled.
 
     Parameters:
     context (object): The context object which contains various attributes used in the function.
@@ -413,114 +432,76 @@ def after_all(context):
     Returns:
     None
     """
-    pass
+    try:
+        executors.shutdown_executors()
+        run_index_page_size = getattr(context, 'bhximgs_run_index_page_size', None) if context is not None else None
+        if run_index_page_size:
+            run_index.build_run_index(run_index_page_size)
+        metrics.write_summary()
+    except Exception as ex:
+        _log_exception_and_continue('after_all (behavex-images)', ex)
 
 
-def copy_gallery_utilities():
+def copy_gallery_utilities(mode=SupportFilesMode.COPY):
     """
-    Copies gallery utilities to the output directory in a multiprocess-safe manner.
+    Provisions gallery utilities in the output directory in a multiprocess-safe manner.
+
+    The gallery utilities are copied, hard linked or symbolically linked from the installed package. A completion
+    marker, stamped with the package version and the content hash of the files, avoids provisioning them again,
+    unless they changed. When the `filelock` library is available, a single process provisions the files, while
+    the other processes poll the completion marker.
 
-    It uses a file lock to ensure that only one process performs the copy. A
-    completion marker file is used to signal that the copy is finished, which
-    avoids unnecessary locking and copying in subsequent runs.
+    Parameters:
+    mode (SupportFilesMode, optional): How the gallery utilities are provisioned. Defaults to SupportFilesMode.COPY.
 
-    If the `filelock` library is not available, it falls back to a non-locking
-    mechanism that is less safe but still attempts to prevent duplicate work by
-    checking for the completion marker.
+    Returns:
+    None
     """
     logs_env = os.getenv('LOGS')
     if not logs_env:
         return
-
-    destination_path = os.path.join(logs_env, 'image_attachments_utils')
-    completion_marker = os.path.join(destination_path, '.copy_complete')
-
-    if os.path.exists(completion_marker):
-        return
-
-    if HAS_FILELOCK:
-        lock_file_path = destination_path + '.lock'
-        try:
-            with FileLock(lock_file_path, timeout=10):
-                # Re-check after acquiring the lock to handle race conditions
-                if os.path.exists(completion_marker):
-                    return
-                _perform_copy(destination_path, completion_marker)
-        except Exception: # pylint: disable=broad-exception-caught
-            # If locking fails (e.g., timeout), assume another process is handling it.
-            pass
-    else:
-        # Fallback for when filelock is not installed. This is not fully
-        # race-proof, but _perform_copy is idempotent.
-        try:
-            _perform_copy(destination_path, completion_marker)
-        except OSError: # pylint: disable=broad-exception-caught
-            # Silently ignore errors, as another process might be copying.
-            pass
-
-
-def _perform_copy(destination_path, completion_marker):
-    """
-    Executes the file copy operation and creates a completion marker.
-
-    It uses the most efficient and safe method available to copy the directory tree.
-    """
-    current_path = os.path.dirname(os.path.abspath(__file__))
-    source_path = os.path.join(current_path, 'utils', 'support_files')
-
-    # The calling function `copy_gallery_utilities` already handles exceptions
-    # that might occur during the copy operation. For Python 3.8+,
-    # copytree has dirs_exist_ok. For older versions, we use a custom implementation.
-    if sys.version_info >= (3, 8):
-        shutil.copytree(source_path, destination_path, dirs_exist_ok=True)
-    else:
-        # Custom implementation for older Python versions
-        _copy_tree_custom(source_path, destination_path)
-    # Create a marker to indicate that the copy is complete.
-    with open(completion_marker, 'w') as f:
-        f.write('complete')
-
-
-def _copy_tree_custom(src, dst):
-    """
-    Custom implementation of copy_tree that works across all Python versions.
-    Recursively copies files and directories from src to dst, creating
-    directories as needed and overwriting existing files.
-    """
-    if not os.path.exists(dst):
-        os.makedirs(dst)
-    
-    for item in os.listdir(src):
-        src_item = os.path.join(src, item)
-        dst_item = os.path.join(dst, item)
-        
-        if os.path.isdir(src_item):
-            _copy_tree_custom(src_item, dst_item)
-        else:
-            shutil.copy2(src_item, dst_item)
+    copy_started = metrics.start()
+    try:
+        provisioning.provision_support_files(logs_env, mode)
+    except OSError as ex:
+        _log_exception_and_continue('copy_gallery_utilities (behavex-images)', ex)
+    finally:
+        metrics.stop('copy_gallery_utilities', copy_started)
 
 
 def close_log_handler(handler):
     """
-    This function closes the current log handler and removes it from the logger.
+    This function closes the log capture of the current scenario.
 
-    If the handler has a stream attribute and the stream has a close method, it calls the close method on the stream. Then it removes the handler from the logger.
+    The log records are no longer routed to the log capture, and the log records it captured are discarded.
 
     Parameters:
-    handler (object): The log handler to be closed and removed.
+    handler (object): The log capture to be closed.
 
     Returns:
     None
     """
     if handler is not None:
         try:
-            if hasattr(handler, 'stream') and hasattr(handler.stream, 'close'):
-                handler.stream.close()
-            logging.getLogger().removeHandler(handler)
+            log_capture.stop_capture(handler)
         except Exception as ex:
             _log_exception_and_continue('close_log_handler (behavex-images)', ex)
 
 
+def _get_scenario_status(scenario):
+    """Returns the status of the scenario as text, for both behave 1.2.6 and 1.3 status values"""
+    status = getattr(scenario, 'status', None)
+    return str(getattr(status, 'name', status or ''))
+
+
+def _find_context(args):
+    """Returns the first hook argument that looks like a behave context, as context might be None in Behave 1.2.6"""
+    for arg in args:
+        if hasattr(arg, 'config') or hasattr(arg, 'feature'):
+            return arg
+    return None
+
+
 def _log_exception_and_continue(module, exception):
     """Logs any exception that occurs without raising it"""
     error_message = f"Unexpected error in '{module}' function:"
@@ -1,11 +1,19 @@
+import asyncio
 import os
 import logging
 from enum import Enum
 
-from PIL import Image
 from io import BytesIO
-from behavex_images.utils.report_utils import normalize_log, add_image_to_report_story
-from behavex_images.utils import image_hash, image_format
+from behavex_images.utils.report_utils import (DEFAULT_DUMP_WORKERS, DEFAULT_THUMBNAIL_SIZE, add_image_to_report_story, normalize_log,
+                                               remove_spilled_images, spill_images_to_disk)
+from behavex_images.utils import image_format, executors, hash_cache, hash_index, image_store, metrics
+from behavex_images.utils.log_capture import DEFAULT_MAX_LOG_BYTES, DEFAULT_MAX_LOG_LINES
+from behavex_images.utils.provisioning import SupportFilesMode
+from behavex_images.utils.replay import DEFAULT_FRAME_DURATION, ReplayFormat
+from behavex_images.utils.run_index import DEFAULT_PAGE_SIZE
+
+# Number of threads used to process the attached images in background, unless configured otherwise
+DEFAULT_BACKGROUND_WORKERS = 2
 
 
 class AttachmentsCondition(Enum):
@@ -22,10 +30,42 @@ class AttachmentsCondition(Enum):
     NEVER = "never"
 
 
+class ImageEncoding(Enum):
+    """
+    This is an enumeration class that defines the format used to store the attached images.
+
+    Attributes:
+    ORIGINAL (str): The images are stored in the format they were attached (PNG or JPEG), without being encoded again.
+    PNG (str): The images are stored as PNG images (JPEG images are converted to PNG).
+    WEBP_LOSSLESS (str): The images are stored as lossless WebP images.
+    WEBP (str): The images are stored as lossy WebP images.
+    """
+    ORIGINAL = "original"
+    PNG = "png"
+    WEBP_LOSSLESS = "webp_lossless"
+    WEBP = "webp"
+
+
+# File extensions of the stored images, by image format
+IMAGE_EXTENSIONS = {'PNG': '.png', 'JPEG': '.jpg', 'WEBP': '.webp'}
+
+# Image encoding policy used unless configured otherwise: images are stored as PNG, using the default compression level
+DEFAULT_IMAGE_ENCODING = {'encoding': ImageEncoding.PNG, 'compress_level': None, 'quality': 80, 'max_dimension': None}
+
+# The fallback to PNG images when a formatter does not support WebP images is only logged once per process
+_webp_formatter_warned = False
+
+
 def attach_image_binary(context, image_binary, header_text=None):
     """
     This function is used to attach an image binary to the execution report.
 
+    When deferred processing is enabled (see set_deferred_processing), the image binary is only recorded,
+    and the PNG conversion, hashing and deduplication are performed in the after_scenario hook, and only
+    if the scenario images are going to be attached to the report.
+    When background processing is enabled (see set_background_processing), the PNG conversion and hashing
+    are performed by a thread pool, and this function returns without waiting for them.
+
     Parameters:
     context (dict): A dictionary that holds the context of the current test execution.
     image_binary (bytes): The binary data of the image to be attached to the report.
@@ -44,43 +84,35 @@ def attach_image_binary(context, image_binary, header_text=None):
         
     if not hasattr(context, 'bhximgs_attachments_condition'):
         context.bhximgs_attachments_condition = AttachmentsCondition.ONLY_ON_FAILURE
+    attach_started = metrics.start()
     try:
+        sniff_started = metrics.start()
         image_binary_format = image_format.get_image_format(image_binary)
+        metrics.stop('attach.sniff', sniff_started, bytes_in=len(image_binary))
         if image_binary_format not in ['PNG', 'JPEG']:
             logging.error('[behavex-images] The provided binary data is not a valid PNG or JPG image.')
             return
-        if image_binary_format == 'JPEG':
-            with BytesIO(image_binary) as f:
-                img = Image.open(f)
-                png_binary_data = BytesIO()
-                img.save(png_binary_data, format='PNG')
-                png_binary_data.seek(0)
-                image_binary = png_binary_data.read()
-        image_stream_hash = image_hash.dhash(Image.open(BytesIO(image_binary)))
     except Exception as exception:
         logging.error('[behavex-images] The provided binary is not a valid image, or could not be converted to PNG: %s' % str(exception))
         return
     try:
-        current_hash = getattr(context, 'bhximgs_image_hash', None)
-        if not current_hash or image_stream_hash != current_hash:
-            context.bhximgs_attached_images_idx = getattr(context, 'bhximgs_attached_images_idx', 0) + 1
-            context.bhximgs_previous_steps = []
-        context.bhximgs_image_hash = image_stream_hash
-        context.bhximgs_image_stream = image_binary
-
-        log_stream = getattr(context, 'bhximgs_log_stream', None)
-        if log_stream and not log_stream.closed:
-            previous_steps = getattr(context, 'bhximgs_previous_steps', [])
-            if header_text:
-                previous_steps.append(normalize_log(header_text, line_breaks=2))
-            for log_line in log_stream.getvalue().splitlines(True):
-                step = normalize_log(log_line)
-                previous_steps.append(step)
-            context.bhximgs_previous_steps = previous_steps
-            log_stream.truncate(0)
-        add_image_to_report_story(context)
+        pending_image = _create_pending_image(context, image_binary, image_binary_format, header_text)
+        if _is_processing_deferred(context):
+            _add_deferred_image(context, pending_image)
+            return
+        background_executor = _get_background_executor(context)
+        if background_executor:
+            if 'same_as' not in pending_image:
+                pending_image['future'] = background_executor.submit(_encode_pending_image, pending_image)
+            _add_pending_image(context, pending_image)
+            _process_completed_images(context)
+            return
+        _process_pending_image(context, pending_image)
+        spill_images_to_disk(context)
     except Exception as exception:
         logging.error('[behavex-images] It was not possible to add the image to the report: %s' % str(exception))
+    finally:
+        metrics.stop('attach', attach_started, bytes_in=len(image_binary))
 
 
 def attach_image_file(context, file_path, header_text=None):
@@ -111,6 +143,105 @@ def attach_image_file(context, file_path, header_text=None):
         logging.error('[behavex-images] The provided file cannot be found at the specified path:  %s' % file_path)
 
 
+async def attach_image_binary_async(context, image_binary, header_text=None):
+    """
+    This coroutine is used to attach an image binary to the execution report, without blocking the event loop.
+
+    The PNG conversion and hashing are performed by a thread pool. The images are added to the report in the same
+    order this coroutine is called, so several images (e.g. from different pages or tabs) can be attached concurrently.
+
+    Parameters:
+    context (dict): A dictionary that holds the context of the current test execution.
+    image_binary (bytes): The binary data of the image to be attached to the report.
+    header_text (str, optional): The header text associated to the image. Defaults to None.
+
+    Returns:
+    None
+
+    Logs:
+    Error: If the provided binary data is not a valid PNG or JPG image.
+    Error: If it was not possible to add the image to the report.
+    """
+    # Context should not be None when users call this function
+    if context is None:
+        raise ValueError('[behavex-images] Context is None - this function should be called from within a behave test step where context is available')
+
+    if not hasattr(context, 'bhximgs_attachments_condition'):
+        context.bhximgs_attachments_condition = AttachmentsCondition.ONLY_ON_FAILURE
+    try:
+        sniff_started = metrics.start()
+        image_binary_format = image_format.get_image_format(image_binary)
+        metrics.stop('attach.sniff', sniff_started, bytes_in=len(image_binary))
+        if image_binary_format not in ['PNG', 'JPEG']:
+            logging.error('[behavex-images] The provided binary data is not a valid PNG or JPG image.')
+            return
+    except Exception as exception:
+        logging.error('[behavex-images] The provided binary is not a valid image, or could not be converted to PNG: %s' % str(exception))
+        return
+    try:
+        pending_image = _create_pending_image(context, image_binary, image_binary_format, header_text)
+        if _is_processing_deferred(context):
+            _add_deferred_image(context, pending_image)
+            return
+        if 'same_as' not in pending_image:
+            pending_image['future'] = _get_async_executor(context).submit_nowait(_encode_pending_image, pending_image)
+        _add_pending_image(context, pending_image)
+        if 'future' in pending_image:
+            await asyncio.wait([asyncio.wrap_future(pending_image['future'])])
+        _process_completed_images(context)
+    except Exception as exception:
+        logging.error('[behavex-images] It was not possible to add the image to the report: %s' % str(exception))
+
+
+async def attach_image_file_async(context, file_path, header_text=None):
+    """
+    This coroutine is used to attach an image file to the execution report, without blocking the event loop.
+
+    The image file is read, converted to PNG and hashed by a thread pool. The images are added to the report in the
+    same order this coroutine is called, so several images can be attached concurrently.
+
+    Parameters:
+    context (dict): A dictionary that holds the context of the current test execution.
+    file_path (str): The path to the image file to be added to the report.
+    header_text (str, optional): The header text associated to the image, that will be shown in the report. Defaults to None.
+
+    Returns:
+    None
+
+    Logs:
+    Error: If the provided file format is not supported. Only PNG and JPG files can be attached.
+    Error: If the provided file cannot be found at the specified path.
+    """
+    # Context should not be None when users call this function
+    if context is None:
+        raise ValueError('[behavex-images] Context is None - this function should be called from within a behave test step where context is available')
+
+    if not os.path.isfile(file_path):
+        logging.error('[behavex-images] The provided file cannot be found at the specified path:  %s' % file_path)
+        return
+    file_extension = os.path.splitext(file_path)[1]
+    if file_extension.lower() not in ['.jpg', '.png']:
+        logging.error('[behavex-images] The provided file format is not supported. Only PNG and JPG files can be attached.')
+        return
+    if not hasattr(context, 'bhximgs_attachments_condition'):
+        context.bhximgs_attachments_condition = AttachmentsCondition.ONLY_ON_FAILURE
+    try:
+        # The image binary is read by the thread pool, while the image keeps its position in the report
+        pending_image = _create_pending_image(context, None, None, header_text)
+        async_executor = _get_async_executor(context)
+        if _is_processing_deferred(context):
+            pending_image['read_future'] = async_executor.submit_nowait(_read_image_file, file_path)
+            _add_deferred_image(context, pending_image)
+            await asyncio.wait([asyncio.wrap_future(pending_image['read_future'])])
+            return
+        pending_image['future'] = async_executor.submit_nowait(_read_and_encode_pending_image, pending_image, file_path)
+        _add_pending_image(context, pending_image)
+        await asyncio.wait([asyncio.wrap_future(pending_image['future'])])
+        _process_completed_images(context)
+    except Exception as exception:
+        logging.error('[behavex-images] It was not possible to add the image to the report: %s' % str(exception))
+
+
 def clean_all_attached_images(context):
     """
     This function is used to clean all the images associated to the test scenario being executed.
@@ -128,9 +259,96 @@ def clean_all_attached_images(context):
     context.bhximgs_attached_images = {}
     context.bhximgs_attached_images_idx = 0
     context.bhximgs_previous_steps = []
-    log_stream = getattr(context, 'bhximgs_log_stream', None)
-    if log_stream:
-        log_stream.truncate(0)
+    context.bhximgs_image_hash = None
+    context.bhximgs_image_key = None
+    context.bhximgs_images_index = None
+    context.bhximgs_last_attached_result = None
+    context.bhximgs_delta_keyframe = None
+    discard_pending_images(context)
+    remove_spilled_images(context)
+    log_handler = getattr(context, 'bhximgs_step_log_handler', None)
+    if log_handler:
+        log_handler.clear()
+
+
+def process_pending_images(context):
+    """
+    This function processes the images recorded while deferred or background processing was enabled.
+
+    The images are converted to PNG, hashed and deduplicated in the same order they were attached,
+    so the resulting report is the same as if they had been processed when attached. If background
+    processing is enabled, the images still to be converted are processed by the thread pool, and
+    this function waits for all of them to finish.
+
+    Parameters:
+    context (dict): A dictionary that holds the context of the current test execution.
+
+    Returns:
+    None
+    """
+    # Context should not be None when users call this function
+    if context is None:
+        raise ValueError('[behavex-images] Context is None - this function should be called from within a behave test step where context is available')
+
+    pending_images = getattr(context, 'bhximgs_pending_images', None)
+    if not pending_images:
+        return
+    context.bhximgs_pending_images = []
+    background_executor = _get_background_executor(context)
+    if background_executor:
+        for pending_image in pending_images:
+            if 'future' not in pending_image and 'same_as' not in pending_image:
+                pending_image['future'] = background_executor.submit(_encode_pending_image, pending_image)
+    current_step_line = getattr(context, 'bhximgs_current_step_line', 0)
+    try:
+        for pending_image in pending_images:
+            try:
+                _process_pending_image(context, pending_image)
+                spill_images_to_disk(context)
+            except Exception as exception:
+                logging.error('[behavex-images] It was not possible to add the image to the report: %s' % str(exception))
+    finally:
+        context.bhximgs_current_step_line = current_step_line
+
+
+def discard_pending_images(context):
+    """
+    This function discards the images pending to be processed, cancelling their background processing when possible.
+
+    Parameters:
+    context (dict): A dictionary that holds the context of the current test execution.
+
+    Returns:
+    None
+    """
+    for pending_image in getattr(context, 'bhximgs_pending_images', []):
+        _discard_pending_image(pending_image)
+    context.bhximgs_pending_images = []
+
+
+def set_attachments_retention(context, last=None):
+    """
+    This function is used to keep only the last images attached in each scenario.
+
+    When configured, attached images are only recorded (as with deferred processing), and only the last ones are
+    kept, together with their captions. The oldest images are evicted before doing any conversion or hashing on them,
+    which bounds both the memory and the processing cost of long scenarios. It is mostly useful with
+    AttachmentsCondition.ONLY_ON_FAILURE, where only the images captured right before the failure are needed.
+
+    Parameters:
+    context (dict): A dictionary that holds the context of the current test execution
+    last (int, optional): The number of images to keep. Defaults to None (all images are kept).
+
+    Returns:
+    None
+    """
+    # Context should not be None when users call this function
+    if context is None:
+        raise ValueError('[behavex-images] Context is None - this function should be called from within a behave test step where context is available')
+    if last is not None and last < 1:
+        raise ValueError('[behavex-images] The number of images to keep should be greater than zero')
+
+    context.bhximgs_attachments_retention = last
 
 
 def set_attachments_condition(context, attachments_condition: AttachmentsCondition):
@@ -149,3 +367,792 @@ def set_attachments_condition(context, attachments_condition: AttachmentsConditi
         raise ValueError('[behavex-images] Context is None - this function should be called from within a behave test step where context is available')
         
     context.bhximgs_attachments_condition = attachments_condition
+
+
+def set_deferred_processing(context, deferred=True):
+    """
+    This function is used to defer the processing of the attached images until the scenario finishes.
+
+    When enabled, attaching an image only records its binary data and the associated captions. The PNG conversion,
+    hashing and deduplication are performed in the after_scenario hook, only when the scenario status indicates
+    that the images will be attached to the report (e.g. for failing scenarios when using AttachmentsCondition.ONLY_ON_FAILURE).
+
+    Parameters:
+    context (dict): A dictionary that holds the context of the current test execution
+    deferred (bool, optional): True to defer the image processing, False to process images when attached. Defaults to True.
+
+    Returns:
+    None
+    """
+    # Context should not be None when users call this function
+    if context is None:
+        raise ValueError('[behavex-images] Context is None - this function should be called from within a behave test step where context is available')
+
+    context.bhximgs_deferred_processing = deferred
+
+
+def set_background_processing(context, enabled=True, max_workers=DEFAULT_BACKGROUND_WORKERS):
+    """
+    This function is used to process the attached images in background threads.
+
+    When enabled, the PNG conversion and hashing of the attached images are performed by a bounded thread pool,
+    so attach_image_binary and attach_image_file return without waiting for them. The images are added to the
+    report in the same order they were attached, and the after_scenario hook waits for all of them to be processed
+    before dumping them to disk.
+
+    Parameters:
+    context (dict): A dictionary that holds the context of the current test execution
+    enabled (bool, optional): True to process the images in background threads. Defaults to True.
+    max_workers (int, optional): The number of threads used to process the images. Defaults to 2.
+
+    Returns:
+    None
+    """
+    # Context should not be None when users call this function
+    if context is None:
+        raise ValueError('[behavex-images] Context is None - this function should be called from within a behave test step where context is available')
+    if enabled and max_workers < 1:
+        raise ValueError('[behavex-images] The number of background processing workers should be greater than zero')
+
+    context.bhximgs_background_workers = max_workers if enabled else 0
+
+
+def set_duplicates_detection(context, max_distance=0, scenario_wide=False):
+    """
+    This function is used to configure how duplicated images are detected and folded into a single image in the report.
+
+    By default, an image is only considered duplicated if it is identical to the previous attached image. Once configured,
+    images whose hash differs in up to max_distance bits from an attached image (e.g. the same page with a blinking cursor
+    or a spinner frame) are considered duplicates, and their captions are appended to the image already attached.
+
+    Parameters:
+    context (dict): A dictionary that holds the context of the current test execution
+    max_distance (int, optional): The maximum Hamming distance between the image hashes (0 to 64) to consider them duplicates. Defaults to 0.
+    scenario_wide (bool, optional): True to compare with all the images attached in the scenario, False to compare with the previous image only. Defaults to False.
+
+    Returns:
+    None
+    """
+    # Context should not be None when users call this function
+    if context is None:
+        raise ValueError('[behavex-images] Context is None - this function should be called from within a behave test step where context is available')
+    if max_distance < 0:
+        raise ValueError('[behavex-images] The maximum distance between duplicated images should not be negative')
+
+    context.bhximgs_duplicates_max_distance = max_distance
+    context.bhximgs_duplicates_scenario_wide = scenario_wide
+
+
+def set_image_store(context, enabled=True):
+    """
+    This function is used to store the attached images in a content-addressable store shared by the whole execution.
+
+    When enabled, each distinct image is written only once per execution, in the 'image_attachments_store' folder
+    of the output directory, and each scenario holds a hard link to it (or a reference from its gallery, when hard
+    links are not supported). It is safe to use with parallel processes.
+
+    Parameters:
+    context (dict): A dictionary that holds the context of the current test execution
+    enabled (bool, optional): True to use the content-addressable image store. Defaults to True.
+
+    Returns:
+    None
+    """
+    # Context should not be None when users call this function
+    if context is None:
+        raise ValueError('[behavex-images] Context is None - this function should be called from within a behave test step where context is available')
+
+    context.bhximgs_image_store = enabled
+
+
+def set_hash_cache(context, enabled=True):
+    """
+    This function is used to share the hashes of the attached images between the parallel processes of the execution.
+
+    When enabled, each attached image binary is looked up (by its digest) in an append-only cache file
+    (hash_cache.jsonl, in the image store folder under the output directory), and if another process already attached
+    the same image, its hash and stored image are reused, so the image is not decoded, hashed or written to disk again.
+    Each image is appended to the cache file as a JSON line, while holding a file lock when the `filelock` library
+    is installed. As the cache references the images of the content-addressable image
+    store, it also enables the image store (see set_image_store).
+
+    Parameters:
+    context (dict): A dictionary that holds the context of the current test execution
+    enabled (bool, optional): True to use the shared hash cache. Defaults to True.
+
+    Returns:
+    None
+    """
+    # Context should not be None when users call this function
+    if context is None:
+        raise ValueError('[behavex-images] Context is None - this function should be called from within a behave test step where context is available')
+
+    context.bhximgs_hash_cache = enabled
+    if enabled:
+        context.bhximgs_image_store = True
+
+
+def set_delta_encoding(context, enabled=True):
+    """
+    This function is used to hold consecutive attached images as the patch of the region that changed since a keyframe.
+
+    When enabled, the first image of the scenario is kept in full (as a keyframe), and each following image only keeps
+    the bounding box of the region that differs from the keyframe, and its offset. An image is kept in full, becoming
+    the new keyframe, when its size changes or its changed region exceeds half of the image. The full images are rebuilt
+    when they are written to disk, so the report is the same. Only images stored as PNG are delta encoded.
+
+    Parameters:
+    context (dict): A dictionary that holds the context of the current test execution
+    enabled (bool, optional): True to delta encode the attached images. Defaults to True.
+
+    Returns:
+    None
+    """
+    # Context should not be None when users call this function
+    if context is None:
+        raise ValueError('[behavex-images] Context is None - this function should be called from within a behave test step where context is available')
+
+    context.bhximgs_delta_encoding = enabled
+
+
+def set_animated_replay(context, replay_format=ReplayFormat.WEBP, frame_duration=DEFAULT_FRAME_DURATION):
+    """
+    This function is used to encode the images attached to each scenario into a single animated image, instead of
+    writing each image to a separate file.
+
+    The animated replay (replay.webp or replay.png) is created by a worker thread when the scenario finishes, along with
+    a JSON file (replay.json) with the timing and captions of each frame, and the gallery showing the replay. When a
+    formatter is specified, the images are still written to separate files, as the formatter references them.
+
+    Parameters:
+    context (dict): A dictionary that holds the context of the current test execution
+    replay_format (ReplayFormat, optional): The format of the animated replay (WEBP or APNG), or None to write each image
+                                            to a separate file. Defaults to ReplayFormat.WEBP.
+    frame_duration (int, optional): The time (in milliseconds) each image is shown in the replay. Defaults to 1000.
+
+    Returns:
+    None
+    """
+    # Context should not be None when users call this function
+    if context is None:
+        raise ValueError('[behavex-images] Context is None - this function should be called from within a behave test step where context is available')
+    if replay_format is not None and not isinstance(replay_format, ReplayFormat):
+        raise ValueError('[behavex-images] The replay format should be one of the ReplayFormat values')
+    if frame_duration <= 0:
+        raise ValueError('[behavex-images] The frame duration should be greater than zero')
+
+    context.bhximgs_replay_format = replay_format
+    context.bhximgs_replay_frame_duration = frame_duration
+
+
+def set_memory_budget(context, max_bytes=None):
+    """
+    This function is used to limit the memory held by the attached images until the scenario finishes.
+
+    When the size of the image binaries held in memory exceeds the budget, the oldest images are written to a temporary
+    folder under the scenario log path. They are moved to their final location if the scenario images are attached
+    to the report, and removed otherwise.
+
+    Parameters:
+    context (dict): A dictionary that holds the context of the current test execution
+    max_bytes (int, optional): The maximum number of bytes held in memory by the attached images. Defaults to None (no limit).
+
+    Returns:
+    None
+    """
+    # Context should not be None when users call this function
+    if context is None:
+        raise ValueError('[behavex-images] Context is None - this function should be called from within a behave test step where context is available')
+    if max_bytes is not None and max_bytes < 0:
+        raise ValueError('[behavex-images] The memory budget should not be negative')
+
+    context.bhximgs_memory_budget = max_bytes
+
+
+def set_image_encoding(context, image_encoding=ImageEncoding.PNG, compress_level=None, quality=80,
+                       max_dimension=None, attachments_condition=None):
+    """
+    This function is used to set the format used to store the attached images.
+
+    The image encoding can be set for all the scenarios, or only for the scenarios using a given attachments condition
+    (e.g. lossy WebP images when using AttachmentsCondition.ALWAYS, and PNG images otherwise).
+    When a formatter is specified, WebP images are stored as PNG images, as the formatters do not pick them up.
+
+    Parameters:
+    context (dict): A dictionary that holds the context of the current test execution
+    image_encoding (ImageEncoding, optional): The format used to store the images. Defaults to ImageEncoding.PNG.
+    compress_level (int, optional): The PNG compression level, from 0 (no compression, fastest) to 9 (slowest). Defaults to None (Pillow's default, and PNG images are stored without being encoded again).
+    quality (int, optional): The quality of lossy JPEG and WebP images, or the compression effort for lossless WebP images (0 to 100). Defaults to 80.
+    max_dimension (int, optional): The maximum width and height of the stored images, larger images are downscaled by an integer factor. Defaults to None (no limit).
+    attachments_condition (AttachmentsCondition, optional): The attachments condition the image encoding applies to. Defaults to None (all conditions).
+
+    Returns:
+    None
+    """
+    # Context should not be None when users call this function
+    if context is None:
+        raise ValueError('[behavex-images] Context is None - this function should be called from within a behave test step where context is available')
+    if compress_level is not None and not 0 <= compress_level <= 9:
+        raise ValueError('[behavex-images] The PNG compression level should be between 0 and 9')
+    if not 0 <= quality <= 100:
+        raise ValueError('[behavex-images] The image quality should be between 0 and 100')
+    if max_dimension is not None and max_dimension < 1:
+        raise ValueError('[behavex-images] The maximum dimension of the images should be greater than zero')
+    if image_encoding in (ImageEncoding.WEBP, ImageEncoding.WEBP_LOSSLESS):
+        from PIL import features
+        if not features.check('webp'):
+            raise ValueError('[behavex-images] WebP images are not supported by the installed Pillow library')
+
+    if not getattr(context, 'bhximgs_image_encodings', None):
+        context.bhximgs_image_encodings = {}
+    context.bhximgs_image_encodings[attachments_condition] = {
+        'encoding': image_encoding,
+        'compress_level': compress_level,
+        'quality': quality,
+        'max_dimension': max_dimension,
+    }
+
+
+def set_dump_workers(context, max_workers=DEFAULT_DUMP_WORKERS):
+    """
+    This function is used to set the number of threads used to write the images of a scenario to disk.
+
+    Writing the images concurrently reduces the time spent in the after_scenario hook on slow or network file systems.
+
+    Parameters:
+    context (dict): A dictionary that holds the context of the current test execution
+    max_workers (int, optional): The number of threads used to write the images (1 to write them sequentially). Defaults to 4.
+
+    Returns:
+    None
+    """
+    # Context should not be None when users call this function
+    if context is None:
+        raise ValueError('[behavex-images] Context is None - this function should be called from within a behave test step where context is available')
+    if max_workers < 1:
+        raise ValueError('[behavex-images] The number of workers used to write the images should be greater than zero')
+
+    context.bhximgs_dump_workers = max_workers
+
+
+def set_gallery_thumbnails(context, enabled=True, max_size=DEFAULT_THUMBNAIL_SIZE):
+    """
+    This function is used to enable or disable the thumbnails shown in the scenario gallery.
+
+    When enabled, a small JPEG thumbnail is created for each attached image, so the gallery page loads quickly
+    even when the scenario has many large screenshots. The full size images are only loaded when opened in the lightbox.
+
+    Parameters:
+    context (dict): A dictionary that holds the context of the current test execution
+    enabled (bool, optional): True to create thumbnails for the gallery, False to show the images. Defaults to True.
+    max_size (int, optional): The maximum width and height (in pixels) of the thumbnails. Defaults to 250.
+
+    Returns:
+    None
+    """
+    # Context should not be None when users call this function
+    if context is None:
+        raise ValueError('[behavex-images] Context is None - this function should be called from within a behave test step where context is available')
+    if max_size < 1:
+        raise ValueError('[behavex-images] The size of the thumbnails should be greater than zero')
+
+    context.bhximgs_thumbnail_size = max_size if enabled else None
+
+
+def set_incremental_gallery(context, enabled=True):
+    """
+    This function is used to enable or disable the incremental writing of the scenario gallery.
+
+    When enabled, each image is appended to the gallery as soon as it is written to disk, so the gallery of a
+    scenario with many images can be opened while the images are still being written.
+
+    Parameters:
+    context (dict): A dictionary that holds the context of the current test execution
+    enabled (bool, optional): True to append each image to the gallery as it is written, False to write the gallery once. Defaults to True.
+
+    Returns:
+    None
+    """
+    # Context should not be None when users call this function
+    if context is None:
+        raise ValueError('[behavex-images] Context is None - this function should be called from within a behave test step where context is available')
+
+    context.bhximgs_incremental_gallery = enabled
+
+
+def set_run_index(context, enabled=True, page_size=DEFAULT_PAGE_SIZE):
+    """
+    This function is used to enable or disable the run-level image index.
+
+    When enabled, the images attached in each scenario are recorded in a manifest file per process, and the manifests
+    of all the processes are merged into a paged index of all the images attached in the run, as the processes finish.
+    It should be called from the before_all hook, so it applies to all the scenarios (and all the parallel processes).
+
+    Parameters:
+    context (dict): A dictionary that holds the context of the current test execution
+    enabled (bool, optional): True to create the run-level image index, False otherwise. Defaults to True.
+    page_size (int, optional): The number of images shown in each page of the index. Defaults to 500.
+
+    Returns:
+    None
+    """
+    # Context should not be None when users call this function
+    if context is None:
+        raise ValueError('[behavex-images] Context is None - this function should be called from within a behave test step where context is available')
+    if page_size < 1:
+        raise ValueError('[behavex-images] The number of images in each page of the index should be greater than zero')
+
+    context.bhximgs_run_index_page_size = page_size if enabled else None
+
+
+def set_metrics(context, enabled=True):
+    """
+    This function is used to enable or disable the collection of timing and size metrics of the image attachments.
+
+    When enabled, the number of calls, the latencies (total, mean and percentiles) and the bytes processed by each stage
+    (hooks, attaching, encoding and hashing images, writing them to disk and creating the galleries) are recorded, and
+    written when the execution finishes to the image_attachments_metrics.json file, merged across parallel processes.
+    It should be called from the before_all hook, so it applies to the whole execution.
+
+    Parameters:
+    context (dict): A dictionary that holds the context of the current test execution
+    enabled (bool, optional): True to collect metrics, False otherwise. Defaults to True.
+
+    Returns:
+    None
+    """
+    # Context should not be None when users call this function
+    if context is None:
+        raise ValueError('[behavex-images] Context is None - this function should be called from within a behave test step where context is available')
+
+    metrics.enable(enabled)
+
+
+def set_support_files_mode(context, mode=SupportFilesMode.COPY):
+    """
+    This function is used to set how the gallery support files (scripts, styles and images) are provisioned in the output folder.
+
+    Hard links and symbolic links avoid copying the support files for each output folder (falling back to a copy when
+    links are not supported). Symbolic links should not be used if the output folder is moved to another machine.
+    It should be called from the before_all hook, as the support files are provisioned when the execution starts.
+
+    Parameters:
+    context (dict): A dictionary that holds the context of the current test execution
+    mode (SupportFilesMode, optional): One of the SupportFilesMode values (COPY, HARDLINK or SYMLINK). Defaults to SupportFilesMode.COPY.
+
+    Returns:
+    None
+    """
+    # Context should not be None when users call this function
+    if context is None:
+        raise ValueError('[behavex-images] Context is None - this function should be called from within a behave test step where context is available')
+    if not isinstance(mode, SupportFilesMode):
+        raise ValueError('[behavex-images] The support files mode should be one of the SupportFilesMode values')
+
+    context.bhximgs_support_files_mode = mode
+
+
+def set_log_capture_limits(context, max_lines=DEFAULT_MAX_LOG_LINES, max_bytes=DEFAULT_MAX_LOG_BYTES):
+    """
+    This function is used to set the limits of the log captured as captions of the attached images.
+
+    Only the most recent log records captured since the previous image was attached are kept, so chatty scenarios
+    do not hold their whole log in memory. The log records are only formatted when an image is attached.
+
+    Parameters:
+    context (dict): A dictionary that holds the context of the current test execution
+    max_lines (int, optional): The maximum number of log records kept, or None for no limit. Defaults to 1000.
+    max_bytes (int, optional): The maximum size (in bytes) of the log messages kept, or None for no limit. Defaults to 1 MB.
+
+    Returns:
+    None
+    """
+    # Context should not be None when users call this function
+    if context is None:
+        raise ValueError('[behavex-images] Context is None - this function should be called from within a behave test step where context is available')
+    if (max_lines is not None and max_lines < 1) or (max_bytes is not None and max_bytes < 1):
+        raise ValueError('[behavex-images] The log capture limits should be greater than zero')
+
+    context.bhximgs_log_capture_limits = (max_lines, max_bytes)
+    log_handler = getattr(context, 'bhximgs_step_log_handler', None)
+    if log_handler:
+        log_handler.set_limits(max_lines, max_bytes)
+
+
+def _get_background_executor(context):
+    """Returns the thread pool used to process the attached images, or None if background processing is disabled"""
+    max_workers = getattr(context, 'bhximgs_background_workers', 0)
+    if not max_workers:
+        return None
+    return executors.get_executor('attachments', max_workers)
+
+
+def _get_async_executor(context):
+    """Returns the thread pool used by the asynchronous attachment functions"""
+    return _get_background_executor(context) or executors.get_executor('attachments', DEFAULT_BACKGROUND_WORKERS)
+
+
+def _is_processing_deferred(context):
+    """Returns True if the attached images should only be recorded, to be processed when the scenario finishes"""
+    return getattr(context, 'bhximgs_deferred_processing', False) or \
+        bool(getattr(context, 'bhximgs_attachments_retention', None))
+
+
+def _add_deferred_image(context, pending_image):
+    """Records an image to be processed when the scenario finishes, applying the retention policy"""
+    _add_pending_image(context, pending_image)
+    retention = getattr(context, 'bhximgs_attachments_retention', None)
+    if retention:
+        # The oldest images are evicted before doing any processing on them
+        pending_images = context.bhximgs_pending_images
+        for evicted_image in pending_images[:-retention]:
+            _evict_pending_image(evicted_image, pending_images[-retention:])
+        del pending_images[:-retention]
+    spill_images_to_disk(context)
+
+
+def _add_pending_image(context, pending_image):
+    """Adds an image to the list of images pending to be processed"""
+    if not hasattr(context, 'bhximgs_pending_images'):
+        context.bhximgs_pending_images = []
+    context.bhximgs_pending_images.append(pending_image)
+
+
+def _process_completed_images(context):
+    """
+    Adds to the report story the pending images whose background processing has already finished.
+
+    Images are only processed up to the first one still being converted, to preserve the attachment order.
+    """
+    pending_images = getattr(context, 'bhximgs_pending_images', [])
+    completed_images = 0
+    for pending_image in pending_images:
+        # Images identical to a previous image are ready as soon as the previous image is processed
+        if 'same_as' not in pending_image and ('future' not in pending_image or not pending_image['future'].done()):
+            break
+        completed_images += 1
+    if not completed_images:
+        return
+    context.bhximgs_pending_images = pending_images[completed_images:]
+    current_step_line = getattr(context, 'bhximgs_current_step_line', 0)
+    try:
+        for pending_image in pending_images[:completed_images]:
+            _process_pending_image(context, pending_image)
+    finally:
+        context.bhximgs_current_step_line = current_step_line
+    spill_images_to_disk(context)
+
+
+def _evict_pending_image(evicted_image, kept_images):
+    """
+    Evicts an image pending to be processed. If a kept image is identical to it, that image does not hold its own
+    binary, so it inherits the binary (or the spilled file) of the evicted image, and produces the shared result instead.
+    """
+    attached_result = evicted_image.get('attached_result')
+    heir_image = next((kept_image for kept_image in kept_images
+                       if attached_result is not None and kept_image.get('same_as') is attached_result), None)
+    if heir_image is None:
+        _discard_pending_image(evicted_image)
+        return
+    del heir_image['same_as']
+    heir_image['attached_result'] = evicted_image.pop('attached_result')
+    for inherited_key in ('img_binary', 'img_format', 'spill_path', 'future'):
+        if inherited_key in evicted_image:
+            heir_image[inherited_key] = evicted_image.pop(inherited_key)
+
+
+def _discard_pending_image(pending_image):
+    """Discards an image pending to be processed, cancelling its background processing and removing it from disk"""
+    for future_key in ('future', 'read_future'):
+        if future_key in pending_image:
+            pending_image[future_key].cancel()
+    spill_path = pending_image.pop('spill_path', None)
+    if spill_path and os.path.exists(spill_path):
+        os.remove(spill_path)
+
+
+def _get_pending_image_binary(pending_image):
+    """Returns the binary of an image pending to be processed, reading it from disk if it was spilled or not read yet"""
+    if pending_image['img_binary'] is None and 'read_future' in pending_image:
+        pending_image['img_binary'] = pending_image.pop('read_future').result()
+        pending_image['img_format'] = image_format.get_image_format(pending_image['img_binary'])
+    if pending_image['img_binary'] is None and pending_image.get('spill_path'):
+        with open(pending_image['spill_path'], 'rb') as image_file:
+            pending_image['img_binary'] = image_file.read()
+        os.remove(pending_image.pop('spill_path'))
+    return pending_image['img_binary']
+
+
+def _get_image_captions(context, header_text=None):
+    """
+    This function retrieves the captions for the image being attached, from the header text and the log lines
+    captured since the previous image was attached.
+
+    Parameters:
+    context (dict): A dictionary that holds the context of the current test execution.
+    header_text (str, optional): The header text associated to the image. Defaults to None.
+
+    Returns:
+    list: The normalized captions for the image.
+    """
+    captions = []
+    log_handler = getattr(context, 'bhximgs_step_log_handler', None)
+    if log_handler:
+        if header_text:
+            captions.append(normalize_log(header_text, line_breaks=2))
+        for log_line in log_handler.get_lines():
+            captions.append(normalize_log(log_line))
+    return captions
+
+
+def _read_image_file(file_path):
+    """Reads the binary data of an image file"""
+    with open(file_path, 'rb') as image_file:
+        return image_file.read()
+
+
+def _read_and_encode_pending_image(pending_image, file_path):
+    """Reads an image file, encodes it according to the image encoding policy and computes its difference hash"""
+    image_binary = _read_image_file(file_path)
+    return _encode_cached_image_and_hash(pending_image, image_binary, image_format.get_image_format(image_binary))
+
+
+def _encode_pending_image(pending_image):
+    """Encodes an image pending to be processed according to its image encoding policy and computes its difference hash"""
+    image_binary = _get_pending_image_binary(pending_image)
+    return _encode_cached_image_and_hash(pending_image, image_binary, pending_image['img_format'])
+
+
+def _encode_cached_image_and_hash(pending_image, image_binary, image_binary_format):
+    """
+    Encodes and hashes an image pending to be processed, unless the shared hash cache is enabled and the same image
+    binary was already stored by this or another process, in which case the stored image and its hash are reused.
+
+    On a cache miss, the key of the image in the hash cache is kept in the pending image, so the image is recorded
+    in the hash cache once it is written to the image store.
+    """
+    if not pending_image.get('hash_cache'):
+        return _encode_image_and_hash(image_binary, image_binary_format, pending_image['encoding'])
+    lookup_started = metrics.start()
+    image_digest = pending_image.get('digest') or image_store.get_image_digest(image_binary)
+    cache_key = hash_cache.get_cache_key(image_digest, pending_image['encoding'])
+    cached_image = hash_cache.lookup(cache_key)
+    metrics.stop('attach.hash_cache', lookup_started, bytes_in=len(image_binary))
+    if cached_image:
+        try:
+            with open(cached_image['stored_path'], 'rb') as image_file:
+                return image_file.read(), cached_image['hash'], cached_image['extension'], cached_image['size']
+        except (IOError, OSError):
+            # The stored image was removed, so the image is processed again
+            pass
+    pending_image['cache_key'] = cache_key
+    return _encode_image_and_hash(image_binary, image_binary_format, pending_image['encoding'])
+
+
+def _encode_image_and_hash(image_binary, image_binary_format, image_encoding):
+    """
+    This function encodes the image binary according to the image encoding policy and computes its difference hash.
+
+    The image is only decoded and encoded again when required by the policy. Otherwise (e.g. PNG images
+    with the default policy), the original image binary is kept.
+
+    Parameters:
+    image_binary (bytes): The binary data of the image.
+    image_binary_format (str): The format of the image binary ('PNG' or 'JPEG').
+    image_encoding (dict): The image encoding policy (encoding, compress_level, quality and max_dimension).
+
+    Returns:
+    tuple: The encoded image binary, its hash (ImageHash), the file extension for the encoded image and its size (width, height).
+    """
+    # Pillow and the hashing code are imported on the first attached image, so processes that do not attach
+    # images (e.g. dry runs) do not spend time importing them. The other modules import Pillow when needed too
+    from PIL import Image
+    from behavex_images.utils import image_hash
+
+    if image_binary_format not in ['PNG', 'JPEG']:
+        raise ValueError('The provided binary data is not a valid PNG or JPG image')
+    encoding = image_encoding['encoding']
+    if encoding == ImageEncoding.ORIGINAL:
+        output_format = image_binary_format
+    elif encoding == ImageEncoding.PNG:
+        output_format = 'PNG'
+    else:
+        output_format = 'WEBP'
+    with BytesIO(image_binary) as f:
+        img = Image.open(f)
+        max_dimension = image_encoding['max_dimension']
+        reducing_factor = -(-max(img.size) // max_dimension) if max_dimension else 1
+        if output_format == image_binary_format and reducing_factor <= 1 and \
+                (output_format != 'PNG' or image_encoding['compress_level'] is None):
+            # The original image binary is kept, so the image is hashed without being fully decoded (if possible).
+            # The size is read first, as hashing JPEG images decodes them at a reduced size
+            img_size = img.size
+            dhash_started = metrics.start()
+            img_hash = image_hash.dhash(img)
+            metrics.stop('attach.dhash', dhash_started, bytes_in=len(image_binary))
+            return image_binary, img_hash, IMAGE_EXTENSIONS[output_format], img_size
+        encode_started = metrics.start()
+        img.load()
+    if reducing_factor > 1:
+        if img.mode not in ('L', 'RGB', 'RGBA'):
+            img = img.convert('RGBA' if 'A' in img.getbands() or 'transparency' in img.info else 'RGB')
+        img = img.reduce(reducing_factor)
+    encoded_binary_data = BytesIO()
+    if output_format == 'PNG':
+        compress_level = image_encoding['compress_level']
+        img.save(encoded_binary_data, format='PNG', **({} if compress_level is None else {'compress_level': compress_level}))
+    elif output_format == 'JPEG':
+        img.save(encoded_binary_data, format='JPEG', quality=image_encoding['quality'])
+    else:
+        img.save(encoded_binary_data, format='WEBP', quality=image_encoding['quality'],
+                 lossless=encoding == ImageEncoding.WEBP_LOSSLESS)
+    encoded_binary = encoded_binary_data.getvalue()
+    metrics.stop('attach.encode', encode_started, bytes_in=len(image_binary), bytes_out=len(encoded_binary))
+    # The decoded image is hashed, instead of decoding the encoded image again
+    dhash_started = metrics.start()
+    img_hash = image_hash.dhash(img)
+    metrics.stop('attach.dhash', dhash_started, bytes_in=len(image_binary))
+    return encoded_binary, img_hash, IMAGE_EXTENSIONS[output_format], img.size
+
+
+def _get_image_encoding(context):
+    """
+    Returns the image encoding policy for the current attachments condition.
+
+    When a formatter is specified, WebP images are stored as PNG images instead, as the formatters (e.g. Allure) only
+    pick up PNG, JPEG and GIF images.
+    """
+    global _webp_formatter_warned  # pylint: disable=global-statement
+    image_encodings = getattr(context, 'bhximgs_image_encodings', {})
+    attachments_condition = getattr(context, 'bhximgs_attachments_condition', None)
+    image_encoding = image_encodings.get(attachments_condition) or image_encodings.get(None) or DEFAULT_IMAGE_ENCODING
+    if image_encoding['encoding'] in (ImageEncoding.WEBP, ImageEncoding.WEBP_LOSSLESS) and \
+            getattr(context, 'bhximgs_formatter', None):
+        if not _webp_formatter_warned:
+            logging.warning('[behavex-images] WebP images are not supported by the formatter, so PNG images are stored instead')
+            _webp_formatter_warned = True
+        return dict(image_encoding, encoding=ImageEncoding.PNG)
+    return image_encoding
+
+
+def _create_pending_image(context, image_binary, image_binary_format, header_text=None):
+    """
+    Creates the record of an attached image, with the captions and the step line at the moment it was attached.
+
+    The digest of the image binary is compared with the digest of the previous attached image, and if they match
+    (e.g. the same unchanged page is captured in consecutive steps), the image does not keep its binary, and it
+    references the result shared with the previous image, so it is not decoded again. Identical images only reference
+    the shared result (not each other), so the images evicted or spilled to disk are not kept in memory.
+    """
+    pending_image = {
+        'img_binary': image_binary,
+        'img_format': image_binary_format,
+        'encoding': _get_image_encoding(context),
+        'step_line': getattr(context, 'bhximgs_current_step_line', 0),
+        'steps': _get_image_captions(context, header_text),
+        'hash_cache': getattr(context, 'bhximgs_hash_cache', False),
+    }
+    if image_binary is None:
+        return pending_image
+    digest_started = metrics.start()
+    pending_image['digest'] = image_store.get_image_digest(image_binary)
+    metrics.stop('attach.digest', digest_started, bytes_in=len(image_binary))
+    attached_result = getattr(context, 'bhximgs_last_attached_result', None)
+    if attached_result is not None and attached_result['digest'] == pending_image['digest'] and \
+            attached_result['encoding'] == pending_image['encoding']:
+        pending_image['same_as'] = attached_result
+        pending_image['img_binary'] = None
+    else:
+        # The result is shared with the following attached images, in case they are identical
+        attached_result = {'digest': pending_image['digest'], 'encoding': pending_image['encoding']}
+        pending_image['attached_result'] = attached_result
+        context.bhximgs_last_attached_result = attached_result
+    return pending_image
+
+
+def _process_pending_image(context, pending_image):
+    """
+    This function converts, hashes and adds an attached image to the report story.
+
+    Parameters:
+    context (dict): A dictionary that holds the context of the current test execution.
+    pending_image (dict): The attached image binary, format, step line and captions.
+                          If the image was processed in background, it also contains the future with the result.
+
+    Returns:
+    None
+    """
+    attached_result = pending_image.pop('same_as', None)
+    try:
+        if attached_result is not None:
+            # The image is identical to the previous image, so only its captions are added to the report
+            if 'result' not in attached_result:
+                raise ValueError(attached_result.get('error', 'the identical image attached before was not processed'))
+            image_result = attached_result['result']
+        elif 'future' in pending_image:
+            image_result = pending_image['future'].result()
+        else:
+            image_result = _encode_pending_image(pending_image)
+    except Exception as exception:
+        if 'attached_result' in pending_image:
+            pending_image.pop('attached_result')['error'] = str(exception)
+        logging.error('[behavex-images] The provided binary is not a valid image, or could not be converted to PNG: %s' % str(exception))
+        return
+    if 'attached_result' in pending_image:
+        pending_image.pop('attached_result')['result'] = image_result
+    image_binary, image_stream_hash, image_extension, image_size = image_result
+    context.bhximgs_current_step_line = pending_image['step_line']
+    context.bhximgs_image_extension = image_extension
+    context.bhximgs_image_size = image_size
+    context.bhximgs_image_cache_key = pending_image.get('cache_key')
+    if getattr(context, 'bhximgs_duplicates_max_distance', None) is not None:
+        _add_image_without_duplicates(context, image_binary, image_stream_hash, pending_image['steps'])
+        return
+    current_hash = getattr(context, 'bhximgs_image_hash', None)
+    if not current_hash or image_stream_hash != current_hash:
+        context.bhximgs_attached_images_idx = getattr(context, 'bhximgs_attached_images_idx', 0) + 1
+        context.bhximgs_previous_steps = []
+    context.bhximgs_image_hash = image_stream_hash
+    context.bhximgs_image_stream = image_binary
+    previous_steps = getattr(context, 'bhximgs_previous_steps', [])
+    previous_steps.extend(pending_image['steps'])
+    context.bhximgs_previous_steps = previous_steps
+    add_image_to_report_story(context)
+
+
+def _add_image_without_duplicates(context, image_binary, image_stream_hash, steps):
+    """
+    Adds an image to the report story, unless it is a near-duplicate of an image already attached.
+
+    Near-duplicates (images whose hash is within the configured distance) are folded into the existing image,
+    by appending the captions to it. Depending on the configuration, the image is compared with the previous
+    image only, or with all the images attached in the scenario.
+    """
+    max_distance = context.bhximgs_duplicates_max_distance
+    attached_images = getattr(context, 'bhximgs_attached_images', {})
+    duplicate_key = None
+    if getattr(context, 'bhximgs_duplicates_scenario_wide', False):
+        images_index = getattr(context, 'bhximgs_images_index', None)
+        duplicate = images_index.find_nearest(image_stream_hash, max_distance) if images_index else None
+        if duplicate:
+            duplicate_key = duplicate[0]
+    else:
+        current_hash = getattr(context, 'bhximgs_image_hash', None)
+        if current_hash is not None and image_stream_hash - current_hash <= max_distance:
+            duplicate_key = getattr(context, 'bhximgs_image_key', None)
+    if duplicate_key in attached_images:
+        attached_images[duplicate_key]['steps'].extend(steps)
+        context.bhximgs_image_hash = attached_images[duplicate_key].get('hash', image_stream_hash)
+        context.bhximgs_image_key = duplicate_key
+        return
+    context.bhximgs_attached_images_idx = getattr(context, 'bhximgs_attached_images_idx', 0) + 1
+    context.bhximgs_previous_steps = list(steps)
+    context.bhximgs_image_hash = image_stream_hash
+    context.bhximgs_image_stream = image_binary
+    image_key = add_image_to_report_story(context)
+    if image_key is None:
+        return
+    context.bhximgs_image_key = image_key
+    if getattr(context, 'bhximgs_images_index', None) is None:
+        context.bhximgs_images_index = hash_index.HashIndex()
+    context.bhximgs_images_index.add(image_stream_hash, image_key)
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""
+BehaveX - BDD testing library based on Behave
+"""
+# pylint: disable=W0403
+
+# __future__ has been added in order to maintain compatibility
+from __future__ import absolute_import, print_function
+
+from io import BytesIO
+
+# A frame is stored in full (becoming the new keyframe) when its changed region exceeds this ratio of the frame area
+MAX_PATCH_AREA_RATIO = 0.5
+
+
+def decode_frame(image_binary):
+    """
+    This function decodes an image binary into a frame that can be compared with other frames.
+
+    Parameters:
+    image_binary (bytes): The binary data of the image.
+
+    Returns:
+    Image: The decoded frame, in RGBA mode if the image has transparency, or RGB mode otherwise.
+    """
+    from PIL import Image
+
+    with Image.open(BytesIO(image_binary)) as img:
+        frame_mode = 'RGBA' if 'A' in img.getbands() or 'transparency' in img.info else 'RGB'
+        return img.convert(frame_mode) if img.mode != frame_mode else img.copy()
+
+
+def get_patch_box(keyframe, frame):
+    """
+    This function computes the region of a frame that differs from the keyframe.
+
+    Parameters:
+    keyframe (Image): The decoded keyframe.
+    frame (Image): The decoded frame.
+
+    Returns:
+    tuple: The bounding box (left, upper, right, lower) of the changed region, or None if the frame cannot be stored
+           as a patch of the keyframe (different size or mode, or a changed region too large).
+    """
+    from PIL import ImageChops
+
+    if frame.size != keyframe.size or frame.mode != keyframe.mode:
+        return None
+    patch_box = ImageChops.difference(keyframe, frame).getbbox()
+    if patch_box is None:
+        # The frame is identical to the keyframe, so a single pixel is kept
+        return 0, 0, 1, 1
+    left, upper, right, lower = patch_box
+    if (right - left) * (lower - upper) > MAX_PATCH_AREA_RATIO * frame.size[0] * frame.size[1]:
+        return None
+    return patch_box
+
+
+def encode_patch(frame, patch_box):
+    """
+    This function encodes the changed region of a frame as a PNG image.
+
+    Parameters:
+    frame (Image): The decoded frame.
+    patch_box (tuple): The bounding box of the changed region (see get_patch_box).
+
+    Returns:
+    bytes: The PNG binary of the changed region.
+    """
+    patch_binary_data = BytesIO()
+    frame.crop(patch_box).save(patch_binary_data, format='PNG')
+    return patch_binary_data.getvalue()
+
+
+def rebuild_frame(keyframe, patch_binary, offset):
+    """
+    This function rebuilds a full frame from its keyframe and the patch of its changed region.
+
+    Parameters:
+    keyframe (Image): The decoded keyframe (see decode_frame), which is not modified.
+    patch_binary (bytes): The PNG binary of the changed region (see encode_patch).
+    offset (tuple): The position (left, upper) of the changed region in the frame.
+
+    Returns:
+    bytes: The PNG binary of the full frame.
+    """
+    from PIL import Image
+
+    frame = keyframe.copy()
+    with Image.open(BytesIO(patch_binary)) as patch:
+        frame.paste(patch.convert(frame.mode) if patch.mode != frame.mode else patch, tuple(offset))
+    frame_binary_data = BytesIO()
+    frame.save(frame_binary_data, format='PNG')
+    return frame_binary_data.getvalue()
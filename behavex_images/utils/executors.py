@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""
+BehaveX - BDD testing library based on Behave
+"""
+# pylint: disable=W0403
+
+# __future__ has been added in order to maintain compatibility
+from __future__ import absolute_import, print_function
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from behavex_images.utils import hash_cache
+
+_executors = {}
+_executors_lock = threading.Lock()
+
+
+class BoundedExecutor(object):
+    """
+    Thread pool executor that limits the number of tasks waiting to be executed.
+
+    Once the limit is reached, submitting a new task blocks the caller until a previous task finishes,
+    so the memory held by the queued tasks (e.g. image binaries) cannot grow without bound.
+    """
+
+    def __init__(self, max_workers, max_pending=None, thread_name_prefix='behavex-images'):
+        self.max_workers = max_workers
+        self.max_pending = max_pending or max_workers * 2
+        self._semaphore = threading.BoundedSemaphore(self.max_pending)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=thread_name_prefix)
+
+    def submit(self, fn, *args, **kwargs):
+        self._semaphore.acquire()
+        try:
+            future = self._executor.submit(fn, *args, **kwargs)
+        except Exception:
+            self._semaphore.release()
+            raise
+        future.add_done_callback(lambda _: self._semaphore.release())
+        return future
+
+    def submit_nowait(self, fn, *args, **kwargs):
+        """Submits a task without waiting for the pending tasks limit, for callers that must not block (e.g. an event loop)"""
+        return self._executor.submit(fn, *args, **kwargs)
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
+
+
+def get_executor(name, max_workers, max_pending=None):
+    """
+    This function returns the process-wide executor registered with the given name, creating it if needed.
+
+    If the executor exists but was created with a different number of workers, it is replaced by a new one.
+
+    Parameters:
+    name (str): The name of the executor.
+    max_workers (int): The number of worker threads.
+    max_pending (int, optional): The maximum number of tasks waiting to be executed. Defaults to twice the number of workers.
+
+    Returns:
+    BoundedExecutor: The executor registered with the given name.
+    """
+    with _executors_lock:
+        executor = _executors.get(name)
+        if executor is None or executor.max_workers != max_workers or \
+                (max_pending and executor.max_pending != max_pending):
+            if executor is not None:
+                executor.shutdown(wait=False)
+            executor = BoundedExecutor(max_workers, max_pending, thread_name_prefix='behavex-images-' + name)
+            _executors[name] = executor
+        return executor
+
+
+def shutdown_executors(wait=True):
+    """
+    This function shuts down all the executors created by get_executor.
+
+    Parameters:
+    wait (bool, optional): True to wait for the pending tasks to finish. Defaults to True.
+
+    Returns:
+    None
+    """
+    with _executors_lock:
+        executors = list(_executors.values())
+        _executors.clear()
+    for executor in executors:
+        executor.shutdown(wait=wait)
+    # The hash cache is used by the worker threads, so it is only released once they are done
+    hash_cache.close()
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+"""
+BehaveX - BDD testing library based on Behave
+"""
+# pylint: disable=W0403
+
+# __future__ has been added in order to maintain compatibility
+from __future__ import absolute_import, print_function
+
+import os
+import uuid
+
+
+def write_file_atomically(output_filename, binary):
+    """
+    This function writes a binary to a temporary file in the same folder, and renames it to the output filename.
+
+    This way, a partially written file is never visible with the output filename, even if the process is interrupted.
+
+    Parameters:
+    output_filename (str): The name of the output file.
+    binary (bytes): The binary to be written to the file.
+
+    Returns:
+    None
+
+    Raises:
+    OSError: If the file could not be written.
+    """
+    temp_filename = '%s.%s.tmp' % (output_filename, uuid.uuid4().hex)
+    # The temporary file is created with the mode of a regular file (restricted by the umask), which is kept by the rename
+    file_descriptor = os.open(temp_filename, os.O_CREAT | os.O_EXCL | os.O_WRONLY | getattr(os, 'O_BINARY', 0), 0o666)
+    try:
+        with os.fdopen(file_descriptor, 'wb') as output_file:
+            output_file.write(binary)
+        os.replace(temp_filename, output_filename)
+    except Exception:
+        if os.path.exists(temp_filename):
+            os.remove(temp_filename)
+        raise
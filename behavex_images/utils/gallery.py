@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+"""
+BehaveX - BDD testing library based on Behave
+"""
+# pylint: disable=W0403
+
+# __future__ has been added in order to maintain compatibility
+from __future__ import absolute_import, print_function
+
+import os
+from string import Template
+
+from behavex_images.utils import file_utils
+
+# Name of the gallery file created in the scenario images folder
+GALLERY_FILENAME = 'images.html'
+
+# The gallery is rendered from precompiled templates, instead of building a DOM for each scenario
+_GALLERY_HEADER = Template(
+    '<!DOCTYPE html><html class="gallery-html"><head>'
+    '<script type="text/javascript" charset="utf-8"> </script>'
+    '<script src="../image_attachments_utils/jquery-1.11.0.min.js" type="text/javascript"> </script>'
+    '<script src="../image_attachments_utils/lightbox.js" type="text/javascript"> </script>'
+    '<link rel="stylesheet" href="../image_attachments_utils/lightbox.css" />'
+    '<link href="../../bootstrap/css/bootstrap.min.css" rel="stylesheet" />'
+    '<link href="../image_attachments_utils/behavex.css" rel="stylesheet" />'
+    '<title>$title</title></head><body class="gallery-body"><h1 class="gallery-title">$title</h1>'
+    '<div class="gallery-container">'
+)
+_GALLERY_ENTRY = Template(
+    '<a href="$href" data-lightbox="lightbox-test-results" data-title="$caption">'
+    '<img src="$src" class="gallery-image" loading="lazy"$dimensions /></a>'
+)
+_GALLERY_DIMENSIONS = Template(' width="$width" height="$height"')
+_GALLERY_FOOTER = '</div></body></html>'
+
+# The gallery does not declare its encoding, so non-ASCII characters are written as character references
+_GALLERY_ENCODING = ('ascii', 'xmlcharrefreplace')
+
+_TEXT_ESCAPES = (('&', '&amp;'), ('<', '&lt;'), ('>', '&gt;'))
+_ATTRIBUTE_ESCAPES = _TEXT_ESCAPES + (('"', '&quot;'), ('\r', '&#13;'), ('\n', '&#10;'), ('\t', '&#09;'))
+
+
+def render_gallery(title, entries):
+    """
+    This function renders the HTML gallery of a scenario.
+
+    Parameters:
+    title (str): The title of the gallery.
+    entries (list): The gallery entries, as returned by render_gallery_entry.
+
+    Returns:
+    str: The HTML gallery.
+    """
+    return ''.join([_GALLERY_HEADER.substitute(title=escape_text(title))] + list(entries) + [_GALLERY_FOOTER])
+
+
+def render_gallery_entry(folder, image_path, captions=None, thumbnail=None):
+    """
+    This function renders the gallery entry of an image.
+
+    Parameters:
+    folder (str): The path to the folder containing the gallery.
+    image_path (str): The path of the image.
+    captions (list, optional): The captions of the image. Defaults to None.
+    thumbnail (dict, optional): The thumbnail shown in the gallery (see create_thumbnails). Defaults to None, to show the image.
+
+    Returns:
+    str: The HTML gallery entry.
+    """
+    # Images are referenced relative to the gallery, as the report can be moved to another location
+    href = _get_relative_path(folder, image_path)
+    src = href
+    dimensions = ''
+    if thumbnail:
+        src = _get_relative_path(folder, thumbnail['src'])
+        dimensions = _GALLERY_DIMENSIONS.substitute(width=thumbnail['width'], height=thumbnail['height'])
+    img_caption = u''
+    for caption in captions or []:
+        # Try and except structure to maintain compatibility decode cant be used with a string on python3
+        # noinspection PyBroadException
+        try:
+            img_caption = img_caption + caption.decode('utf8')
+        except:
+            img_caption = img_caption + str(caption)
+    return _GALLERY_ENTRY.substitute(
+        href=_escape(href, _ATTRIBUTE_ESCAPES),
+        caption=_escape(img_caption, _ATTRIBUTE_ESCAPES),
+        src=_escape(src, _ATTRIBUTE_ESCAPES),
+        dimensions=dimensions
+    )
+
+
+def write_gallery(folder, title, entries, filename=GALLERY_FILENAME):
+    """
+    This function writes the HTML gallery of a scenario, in a single write.
+
+    Parameters:
+    folder (str): The path to the folder containing the images.
+    title (str): The title of the gallery.
+    entries (list): The gallery entries, as returned by render_gallery_entry.
+    filename (str, optional): The filename of the gallery. Defaults to 'images.html'.
+
+    Returns:
+    None
+    """
+    gallery = render_gallery(title, entries)
+    file_utils.write_file_atomically(os.path.join(folder, filename), gallery.encode(*_GALLERY_ENCODING))
+
+
+class GalleryWriter(object):
+    """
+    Writer that appends the entries to the HTML gallery of a scenario one at a time, as the images are written to disk.
+
+    The gallery is a complete HTML document after each entry is appended, as the entry is written over the closing
+    tags, which are then written again. The gallery file is only created when the first entry is appended.
+    """
+
+    def __init__(self, folder, title):
+        self.folder = os.path.abspath(folder)
+        self.title = title
+        self._gallery_file = None
+        self._entries_end = 0
+
+    def append(self, image_path, captions=None, thumbnail=None):
+        """
+        Appends the entry of an image to the gallery.
+
+        Parameters:
+        image_path (str): The path of the image.
+        captions (list, optional): The captions of the image. Defaults to None.
+        thumbnail (dict, optional): The thumbnail shown in the gallery. Defaults to None, to show the image.
+
+        Returns:
+        None
+        """
+        entry = render_gallery_entry(self.folder, image_path, captions, thumbnail).encode(*_GALLERY_ENCODING)
+        if self._gallery_file is None:
+            self._gallery_file = open(os.path.join(self.folder, GALLERY_FILENAME), 'wb')
+            self._gallery_file.write(_GALLERY_HEADER.substitute(title=escape_text(self.title)).encode(*_GALLERY_ENCODING))
+            self._entries_end = self._gallery_file.tell()
+        self._gallery_file.seek(self._entries_end)
+        self._gallery_file.write(entry)
+        self._entries_end = self._gallery_file.tell()
+        self._gallery_file.write(_GALLERY_FOOTER.encode(*_GALLERY_ENCODING))
+        self._gallery_file.flush()
+
+    def close(self):
+        if self._gallery_file is not None:
+            self._gallery_file.close()
+            self._gallery_file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _get_relative_path(folder, path):
+    """Returns the path relative to the gallery folder, with forward slashes to be used in the HTML gallery"""
+    return os.path.relpath(os.path.join(folder, path), folder).replace(os.sep, '/')
+
+
+def escape_text(text):
+    """
+    This function escapes the HTML special characters in a text.
+
+    Parameters:
+    text (str): The text to be escaped.
+
+    Returns:
+    str: The escaped text.
+    """
+    return _escape(text, _TEXT_ESCAPES)
+
+
+def _escape(value, escapes):
+    """Escapes the HTML special characters in a text or attribute value"""
+    value = u'%s' % value
+    for character, replacement in escapes:
+        if character in value:
+            value = value.replace(character, replacement)
+    return value
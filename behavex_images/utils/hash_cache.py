@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+"""
+BehaveX - BDD testing library based on Behave
+"""
+# pylint: disable=W0403
+
+# __future__ has been added in order to maintain compatibility
+from __future__ import absolute_import, print_function
+
+import json
+import logging
+import os
+import threading
+
+# Third-party imports
+try:
+    from filelock import FileLock
+    HAS_FILELOCK = True
+except ImportError:
+    HAS_FILELOCK = False
+
+from behavex_images.utils import image_store
+
+# File (under the image store folder) of the hash cache shared by the parallel processes
+HASH_CACHE_FILENAME = 'hash_cache.jsonl'
+
+# Maximum time (in seconds) a process waits for another process appending to the hash cache
+HASH_CACHE_TIMEOUT = 30
+
+# The hash cache is an append-only file with one JSON line per image, so it does not depend on the locking of a
+# database (unreliable on network file systems). Each process keeps the lines already read in memory, and only reads
+# the lines appended by other processes when an image is not found.
+_cache_lock = threading.Lock()
+_cache = {'path': None, 'offset': 0, 'images': {}}
+
+
+def get_hash_cache_path():
+    """
+    This function returns the path of the hash cache shared by the parallel processes.
+
+    Returns:
+    str: The path of the hash cache, or None if the LOGS environment variable is not set.
+    """
+    store_path = image_store.get_image_store_path()
+    if not store_path:
+        return None
+    return os.path.join(store_path, HASH_CACHE_FILENAME)
+
+
+def get_cache_key(image_digest, image_encoding):
+    """
+    This function returns the key of an image in the hash cache.
+
+    Parameters:
+    image_digest (str): The digest of the attached image binary (see image_store.get_image_digest).
+    image_encoding (dict): The image encoding policy (encoding, compress_level, quality and max_dimension),
+                           as the same image binary is stored differently depending on the policy.
+
+    Returns:
+    str: The key of the image in the hash cache.
+    """
+    return '%s:%s:%s:%s:%s' % (image_digest, image_encoding['encoding'].value, image_encoding['compress_level'],
+                               image_encoding['quality'], image_encoding['max_dimension'])
+
+
+def lookup(cache_key):
+    """
+    This function looks up an image in the hash cache.
+
+    Parameters:
+    cache_key (str): The key of the image (see get_cache_key).
+
+    Returns:
+    dict: The hash (ImageHash), extension, size (width, height) and stored path of the image, or None if the image
+          is not in the hash cache, or its stored image no longer exists.
+    """
+    cache_path = get_hash_cache_path()
+    if not cache_path:
+        return None
+    with _cache_lock:
+        cached_image = _get_images(cache_path).get(cache_key)
+        if cached_image is None:
+            _read_appended_images(cache_path)
+            cached_image = _cache['images'].get(cache_key)
+    if cached_image is None or not os.path.isfile(cached_image['path']):
+        return None
+    from behavex_images.utils.image_hash import ImageHash
+    return {
+        'hash': ImageHash.from_int(int.from_bytes(bytes.fromhex(cached_image['hash']), 'little'),
+                                   (cached_image['rows'], cached_image['cols'])),
+        'extension': cached_image['extension'],
+        'size': tuple(cached_image['size']) if cached_image['size'] else None,
+        'stored_path': cached_image['path'],
+    }
+
+
+def record(cache_key, img_hash, extension, size, stored_path):
+    """
+    This function records an image stored in the image store, so other processes do not process it again.
+
+    When the `filelock` library is available, the line of the image is appended while holding a lock, so the lines
+    appended by the parallel processes are never interleaved.
+
+    Parameters:
+    cache_key (str): The key of the image (see get_cache_key).
+    img_hash (ImageHash): The difference hash of the image.
+    extension (str): The file extension of the stored image.
+    size (tuple): The width and height of the image, or None if unknown.
+    stored_path (str): The path of the image in the image store.
+
+    Returns:
+    None
+    """
+    cache_path = get_hash_cache_path()
+    if not cache_path or img_hash is None:
+        return
+    cached_image = {'key': cache_key, 'hash': str(img_hash), 'rows': img_hash.shape[0], 'cols': img_hash.shape[1],
+                    'extension': extension, 'size': list(size) if size else None, 'path': stored_path}
+    cache_line = (json.dumps(cached_image, separators=(',', ':')) + '\n').encode('utf-8')
+    try:
+        if HAS_FILELOCK:
+            try:
+                with FileLock(cache_path + '.lock', timeout=HASH_CACHE_TIMEOUT):
+                    _append_line(cache_path, cache_line)
+                return
+            except Exception:  # pylint: disable=broad-exception-caught
+                # If locking fails (e.g. timeout), the line is appended anyway, as incomplete lines are ignored
+                pass
+        _append_line(cache_path, cache_line)
+    except (IOError, OSError) as exception:
+        logging.warning('[behavex-images] The image could not be added to the hash cache: %s' % str(exception))
+
+
+def close():
+    """Releases the images of the hash cache read by the current process"""
+    with _cache_lock:
+        _cache.update({'path': None, 'offset': 0, 'images': {}})
+
+
+def _append_line(cache_path, cache_line):
+    """Appends a line to the hash cache with a single write"""
+    file_descriptor = os.open(cache_path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o666)
+    try:
+        os.write(file_descriptor, cache_line)
+    finally:
+        os.close(file_descriptor)
+
+
+def _get_images(cache_path):
+    """Returns the images of the hash cache read by the current process, for the given hash cache path"""
+    if _cache['path'] != cache_path:
+        _cache.update({'path': cache_path, 'offset': 0, 'images': {}})
+    return _cache['images']
+
+
+def _read_appended_images(cache_path):
+    """Reads the complete lines appended to the hash cache since it was last read by the current process"""
+    try:
+        if os.path.getsize(cache_path) <= _cache['offset']:
+            return
+        with open(cache_path, 'rb') as cache_file:
+            cache_file.seek(_cache['offset'])
+            appended_data = cache_file.read()
+    except (IOError, OSError):
+        return
+    # A line still being appended by another process is read again on the next lookup
+    complete_data = appended_data[:appended_data.rfind(b'\n') + 1]
+    _cache['offset'] += len(complete_data)
+    for cache_line in complete_data.splitlines():
+        try:
+            cached_image = json.loads(cache_line.decode('utf-8'))
+            _cache['images'][cached_image['key']] = cached_image
+        except (ValueError, KeyError, TypeError):
+            logging.warning('[behavex-images] An invalid line of the hash cache was ignored')
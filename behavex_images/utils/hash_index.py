@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""
+BehaveX - BDD testing library based on Behave
+"""
+# pylint: disable=W0403, R0903
+
+# __future__ has been added in order to maintain compatibility
+from __future__ import absolute_import, print_function
+
+
+class HashIndex(object):
+    """
+    Index of image hashes, to find the stored hash closest to a given one.
+
+    It is implemented as a BK-tree over the Hamming distance between hashes, so a lookup
+    only visits the subtrees that can contain a hash within the requested distance.
+    """
+
+    __slots__ = ('_root', '_size')
+
+    def __init__(self):
+        # Each node is a list: [image_hash, item, {distance: child_node}]
+        self._root = None
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def add(self, image_hash, item):
+        """
+        Adds a hash to the index, associated to the given item.
+
+        Parameters:
+        image_hash (ImageHash): The hash to be added.
+        item (object): The item associated to the hash (e.g. the image key).
+
+        Returns:
+        None
+        """
+        new_node = [image_hash, item, {}]
+        self._size += 1
+        if self._root is None:
+            self._root = new_node
+            return
+        node = self._root
+        while True:
+            distance = image_hash - node[0]
+            child_node = node[2].get(distance)
+            if child_node is None:
+                node[2][distance] = new_node
+                return
+            node = child_node
+
+    def find_nearest(self, image_hash, max_distance=0):
+        """
+        Finds the indexed hash closest to the given one, within the maximum distance.
+
+        Parameters:
+        image_hash (ImageHash): The hash to look for.
+        max_distance (int, optional): The maximum Hamming distance between the hashes. Defaults to 0.
+
+        Returns:
+        tuple: The item associated to the closest hash and its distance, or None if no hash is within the maximum distance.
+        """
+        if self._root is None:
+            return None
+        best_match = None
+        best_distance = max_distance + 1
+        nodes = [self._root]
+        while nodes:
+            node = nodes.pop()
+            distance = image_hash - node[0]
+            if distance < best_distance:
+                best_match, best_distance = node, distance
+                if distance == 0:
+                    break
+            for child_distance, child_node in node[2].items():
+                if distance - best_distance < child_distance < distance + best_distance:
+                    nodes.append(child_node)
+        if best_match is None:
+            return None
+        return best_match[1], best_distance
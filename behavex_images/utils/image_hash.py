@@ -8,64 +8,95 @@ from __future__ import absolute_import, print_function
 
 from PIL import Image
 
+# Python 3.10+ provides a native popcount
+try:
+    _popcount = int.bit_count
+except AttributeError:
+    def _popcount(value):
+        """count the bits set in a non-negative int"""
+        return bin(value).count('1')
 
-def binary_array_to_hex(arr):
-    """convert from array to hex"""
-    hex_ = 0
-    sub = []
-    flat_arr = [item for sublist in arr for item in sublist]
+
+def binary_array_to_int(arr):
+    """convert from (nested) binary array to int, where the bit i of the flattened array is the bit i of the int"""
+    value = 0
+    flat_arr = [item for sublist in arr for item in sublist] if arr and isinstance(arr[0], (list, tuple)) else arr
     for i, vect in enumerate(flat_arr):
         if vect:
-            hex_ += 2 ** (i % 8)
-        if (i % 8) == 7:
-            sub.append(hex(hex_)[2:].rjust(2, '0'))
-            hex_ = 0
-    return ''.join(sub)
+            value |= 1 << i
+    return value
 
 
-def binary_array_to_int(arr):
-    """convert from binary array to int"""
-    return sum([2 ** (i % 8) for i, v in enumerate(arr.flatten()) if v])
+def int_to_hex(value, bits):
+    """convert from int to hex, two hex digits per byte, least significant byte first"""
+    return value.to_bytes((bits + 7) // 8, 'little').hex()
+
+
+def binary_array_to_hex(arr):
+    """convert from array to hex"""
+    flat_arr = [item for sublist in arr for item in sublist]
+    return int_to_hex(binary_array_to_int(flat_arr), len(flat_arr))
 
 
 class ImageHash(object):
     """
     Hash encapsulation. Can be used for dictionary keys and comparisons.
+
+    The hash bits are packed into a single int, so the Hamming distance between two hashes
+    is computed with a XOR and a popcount.
     """
 
+    __slots__ = ('value', 'shape')
+
     def __init__(self, binary_array):
-        self.hash = binary_array
+        self.shape = (len(binary_array), len(binary_array[0]) if binary_array else 0)
+        self.value = binary_array_to_int(binary_array)
+
+    @classmethod
+    def from_int(cls, value, shape):
+        """build a hash from its packed int value and its (rows, columns) shape"""
+        image_hash = cls.__new__(cls)
+        image_hash.value = value
+        image_hash.shape = shape
+        return image_hash
+
+    @property
+    def hash(self):
+        """the hash as a nested list of bools"""
+        rows, cols = self.shape
+        return [[bool(self.value >> (row * cols + col) & 1) for col in range(cols)] for row in range(rows)]
 
     def __str__(self):
-        return binary_array_to_hex(self.hash)
+        return int_to_hex(self.value, self.shape[0] * self.shape[1])
 
     def __repr__(self):
-        return repr(self.hash)
+        return '%s(%s)' % (self.__class__.__name__, str(self))
 
     def __sub__(self, other):
         if not isinstance(other, self.__class__):
             raise TypeError('unsupported operand type(s) for -')
-        if len(self.hash) != len(other.hash) or len(self.hash[0]) != len(other.hash[0]):
-            raise ValueError(
-                'ImageHashes must be of the same shape!',
-                (len(self.hash), len(self.hash[0])),
-                (len(other.hash), len(other.hash[0])),
-            )
-        flat_self = [item for sublist in self.hash for item in sublist]
-        flat_other = [item for sublist in other.hash for item in sublist]
-        return sum(1 for x, y in zip(flat_self, flat_other) if x != y)
+        if self.shape != other.shape:
+            raise ValueError('ImageHashes must be of the same shape!', self.shape, other.shape)
+        return _popcount(self.value ^ other.value)
 
     def __eq__(self, other):
         """Function especial eq"""
         if not isinstance(other, self.__class__):
             return False
-        return self.hash == other.hash
+        return self.value == other.value and self.shape == other.shape
 
     def __ne__(self, other):
         return not self.__eq__(other)
 
     def __hash__(self):
-        return binary_array_to_int(self.hash)
+        return self.value
+
+
+# Modes that can be downscaled with Image.reduce before the conversion to grayscale
+_REDUCIBLE_MODES = ('L', 'LA', 'RGB', 'RGBA', 'RGBX', 'CMYK', 'YCbCr')
+# The image is downscaled with a fast filter to approximately this factor times the hash size,
+# before applying the LANCZOS filter, which is expensive on large images
+_REDUCING_GAP = 8
 
 
 def dhash(image, hash_size=8):
@@ -74,23 +105,30 @@ def dhash(image, hash_size=8):
     following http://www.hackerfactor.com/blog/index.php?/archives/
     529-Kind-of-Like-That.html
     @image must be a PIL instance.
-    """
-    image = image.convert('L').resize((hash_size + 1, hash_size), Image.LANCZOS)
-    pixels_data = list(image.getdata())
-    pixels = []
-    for row_num in range(hash_size):
-        row = []
-        for col_num in range(hash_size + 1):
-            row.append(pixels_data[row_num * (hash_size + 1) + col_num])
-        pixels.append(row)
 
-    diff = []
+    Large images are downscaled before the grayscale conversion and the final LANCZOS resize:
+    JPEG images not loaded yet are decoded at a reduced scale (DCT domain downscale, see Image.draft),
+    and other images are reduced with a box filter (see Image.reduce).
+    """
+    width, height = hash_size + 1, hash_size
+    draft_size = (width * _REDUCING_GAP, height * _REDUCING_GAP)
+    if image.format == 'JPEG':
+        # It has no effect if the image was already loaded
+        image.draft('L', draft_size)
+    reducing_factor = min(image.size[0] // draft_size[0], image.size[1] // draft_size[1])
+    if reducing_factor > 1 and image.mode in _REDUCIBLE_MODES:
+        image = image.reduce(reducing_factor)
+    image = image.convert('L').resize((width, height), Image.LANCZOS)
+    pixels = image.tobytes()
+    value = 0
     for row_num in range(hash_size):
-        diff_row = []
-        for col_num in range(hash_size):
-            diff_row.append(pixels[row_num][col_num + 1] > pixels[row_num][col_num])
-        diff.append(diff_row)
-    return ImageHash(diff)
+        row = pixels[row_num * width:(row_num + 1) * width]
+        row_bits = 0
+        for col_num, (left, right) in enumerate(zip(row, row[1:])):
+            if right > left:
+                row_bits |= 1 << col_num
+        value |= row_bits << (row_num * hash_size)
+    return ImageHash.from_int(value, (hash_size, hash_size))
 
 
 __dir__ = [ImageHash]
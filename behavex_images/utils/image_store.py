@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""
+BehaveX - BDD testing library based on Behave
+"""
+# pylint: disable=W0403
+
+# __future__ has been added in order to maintain compatibility
+from __future__ import absolute_import, print_function
+
+import hashlib
+import os
+
+# Third-party imports
+try:
+    from filelock import FileLock, Timeout
+    HAS_FILELOCK = True
+except ImportError:
+    HAS_FILELOCK = False
+
+from behavex_images.utils import file_utils
+
+# Folder (under the LOGS folder) where the images are stored, named by the digest of their content
+IMAGE_STORE_FOLDER = 'image_attachments_store'
+
+
+def get_image_store_path():
+    """
+    This function returns the path of the run-wide image store.
+
+    Returns:
+    str: The path of the image store, or None if the LOGS environment variable is not set.
+    """
+    logs_env = os.getenv('LOGS')
+    if not logs_env:
+        return None
+    return os.path.join(logs_env, IMAGE_STORE_FOLDER)
+
+
+def get_image_digest(image_binary):
+    """
+    This function computes the digest used to identify an image binary in the image store.
+
+    Parameters:
+    image_binary (bytes): The image binary.
+
+    Returns:
+    str: The hexadecimal digest of the image binary.
+    """
+    return hashlib.blake2b(image_binary, digest_size=16).hexdigest()
+
+
+def store_image(image_binary, extension='.png'):
+    """
+    This function stores an image binary in the run-wide image store, unless an identical image was already stored.
+
+    Images are written to a temporary file and renamed, so a partially written image is never visible.
+    When the `filelock` library is available, a lock per digest prefix ensures that only one of the parallel
+    processes writes each image.
+
+    Parameters:
+    image_binary (bytes): The image binary to be stored.
+    extension (str, optional): The extension of the stored file. Defaults to '.png'.
+
+    Returns:
+    str: The path of the stored image, or None if the image store is not available.
+    """
+    store_path = get_image_store_path()
+    if not store_path:
+        return None
+    digest = get_image_digest(image_binary)
+    object_folder = os.path.join(store_path, digest[:2])
+    object_path = os.path.join(object_folder, digest + extension)
+    if os.path.exists(object_path):
+        return object_path
+    if not os.path.isdir(object_folder):
+        os.makedirs(object_folder, exist_ok=True)
+    if HAS_FILELOCK:
+        try:
+            with FileLock(object_folder + '.lock', timeout=10):
+                # Re-check after acquiring the lock, as another process could have stored the image
+                if not os.path.exists(object_path):
+                    file_utils.write_file_atomically(object_path, image_binary)
+            return object_path
+        except Timeout:
+            # If the lock is not acquired in time, the image is written anyway, as the rename is atomic
+            pass
+    if not os.path.exists(object_path):
+        file_utils.write_file_atomically(object_path, image_binary)
+    return object_path
+
+
+def link_image(object_path, output_filename):
+    """
+    This function creates a hard link to a stored image.
+
+    Parameters:
+    object_path (str): The path of the image in the image store.
+    output_filename (str): The path of the hard link to be created.
+
+    Returns:
+    bool: True if the hard link was created, False otherwise (e.g. if the file system does not support hard links).
+    """
+    try:
+        if os.path.exists(output_filename):
+            os.remove(output_filename)
+        os.link(object_path, output_filename)
+    except (OSError, AttributeError, NotImplementedError):
+        return False
+    return True
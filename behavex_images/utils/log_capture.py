@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+"""
+BehaveX - BDD testing library based on Behave
+"""
+# pylint: disable=W0403
+
+# __future__ has been added in order to maintain compatibility
+from __future__ import absolute_import, print_function
+
+import contextvars
+import logging
+import sys
+import threading
+from collections import deque
+
+# Maximum number of log records kept between two attached images, unless configured otherwise
+DEFAULT_MAX_LOG_LINES = 1000
+
+# Maximum size (in bytes) of the log records kept between two attached images, unless configured otherwise
+DEFAULT_MAX_LOG_BYTES = 1024 * 1024
+
+# Log capture of the active scenario, for the code running in the scenario context
+_active_capture = contextvars.ContextVar('behavex_images_log_capture', default=None)
+# Log capture of the active scenario, for the threads that do not share the scenario context
+_process_capture = None
+_routing_handler = None
+_routing_handler_lock = threading.Lock()
+
+
+class LogCaptureHandler(logging.Handler):
+    """
+    Log handler that captures the log records used as captions of the attached images.
+
+    The records are kept unformatted in a bounded queue, and they are only formatted when the captions of an image
+    are built, so the logs of scenarios that do not attach images are never formatted. When the limits are reached,
+    the oldest records are discarded.
+    """
+
+    def __init__(self, max_lines=DEFAULT_MAX_LOG_LINES, max_bytes=DEFAULT_MAX_LOG_BYTES):
+        logging.Handler.__init__(self)
+        self.max_lines = max_lines
+        self.max_bytes = max_bytes
+        self._records = deque()
+        self._records_bytes = 0
+        self._discarded_records = 0
+        self._records_lock = threading.Lock()
+
+    def set_limits(self, max_lines=DEFAULT_MAX_LOG_LINES, max_bytes=DEFAULT_MAX_LOG_BYTES):
+        """
+        Sets the maximum number of log records, and their maximum size, kept between two attached images.
+
+        Parameters:
+        max_lines (int, optional): The maximum number of log records, or None for no limit. Defaults to 1000.
+        max_bytes (int, optional): The maximum size of the log records, or None for no limit. Defaults to 1 MB.
+
+        Returns:
+        None
+        """
+        with self._records_lock:
+            self.max_lines = max_lines
+            self.max_bytes = max_bytes
+            self._discard_exceeding_records()
+
+    def emit(self, record):
+        record_bytes = _get_record_size(record)
+        with self._records_lock:
+            self._records.append((record, record_bytes))
+            self._records_bytes += record_bytes
+            self._discard_exceeding_records()
+
+    def get_lines(self):
+        """
+        Formats the captured log records, and clears them.
+
+        Returns:
+        list: The log lines, including their line breaks.
+        """
+        with self._records_lock:
+            records = self._records
+            discarded_records = self._discarded_records
+            self._records = deque()
+            self._records_bytes = 0
+            self._discarded_records = 0
+        log_lines = []
+        if discarded_records:
+            log_lines.append('[behavex-images] %d log records were discarded\n' % discarded_records)
+        for record, _ in records:
+            try:
+                log_lines.extend((self.format(record) + '\n').splitlines(True))
+            except Exception:  # pylint: disable=broad-exception-caught
+                self.handleError(record)
+        return log_lines
+
+    def clear(self):
+        """Discards the captured log records"""
+        with self._records_lock:
+            self._records.clear()
+            self._records_bytes = 0
+            self._discarded_records = 0
+
+    def close(self):
+        self.clear()
+        logging.Handler.close(self)
+
+    def _discard_exceeding_records(self):
+        """Discards the oldest records, until the limits are met"""
+        while self._records and ((self.max_lines and len(self._records) > self.max_lines) or
+                                 (self.max_bytes and self._records_bytes > self.max_bytes)):
+            _, record_bytes = self._records.popleft()
+            self._records_bytes -= record_bytes
+            self._discarded_records += 1
+
+
+def _get_record_size(record):
+    """Returns the approximate size of a log record, without formatting it"""
+    size = _get_value_size(record.msg) + len(record.stack_info or '')
+    if isinstance(record.args, dict):
+        size += sum(_get_value_size(arg) for arg in record.args.values())
+    elif record.args:
+        size += sum(_get_value_size(arg) for arg in record.args)
+    return size
+
+
+def _get_value_size(value):
+    """Returns the length of a text or binary value, or the memory size of any other value"""
+    if isinstance(value, (str, bytes)):
+        return len(value)
+    return sys.getsizeof(value)
+
+
+class LogRoutingHandler(logging.Handler):
+    """
+    Log handler installed once in the root logger, that routes the log records to the log capture of the active scenario.
+
+    The log records emitted while no scenario is active are ignored.
+    """
+
+    def emit(self, record):
+        log_capture = _active_capture.get() or _process_capture
+        if log_capture is not None:
+            log_capture.emit(record)
+
+
+def install_routing_handler(formatter=None):
+    """
+    This function installs the log routing handler in the root logger, unless it is already installed.
+
+    Parameters:
+    formatter (Formatter, optional): The formatter used by the log captures. Defaults to None.
+
+    Returns:
+    LogRoutingHandler: The log routing handler.
+    """
+    global _routing_handler  # pylint: disable=global-statement
+    with _routing_handler_lock:
+        if _routing_handler is None:
+            _routing_handler = LogRoutingHandler()
+        if formatter is not None:
+            _routing_handler.setFormatter(formatter)
+        root_logger = logging.getLogger()
+        # The handler is added again if it was removed (e.g. by behave's logging capture)
+        if _routing_handler not in root_logger.handlers:
+            root_logger.addHandler(_routing_handler)
+        return _routing_handler
+
+
+def is_routing_handler_installed():
+    """
+    This function checks whether the log routing handler is installed in the root logger, without taking any lock.
+
+    Returns:
+    bool: True if the log routing handler is installed, False otherwise (e.g. if it was removed by behave's logging capture).
+    """
+    return _routing_handler is not None and _routing_handler in logging.getLogger().handlers
+
+
+def start_capture(log_capture):
+    """
+    This function routes the log records to the given log capture, until stop_capture is called.
+
+    Parameters:
+    log_capture (LogCaptureHandler): The log capture of the scenario that starts.
+
+    Returns:
+    None
+    """
+    global _process_capture  # pylint: disable=global-statement
+    if log_capture.formatter is None and _routing_handler is not None:
+        log_capture.setFormatter(_routing_handler.formatter)
+    _process_capture = log_capture
+    _active_capture.set(log_capture)
+
+
+def stop_capture(log_capture):
+    """
+    This function stops routing the log records to the given log capture, and closes it.
+
+    Parameters:
+    log_capture (LogCaptureHandler): The log capture of the scenario that finished.
+
+    Returns:
+    None
+    """
+    global _process_capture  # pylint: disable=global-statement
+    if _process_capture is log_capture:
+        _process_capture = None
+    if _active_capture.get() is log_capture:
+        _active_capture.set(None)
+    log_capture.close()
@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+"""
+BehaveX - BDD testing library based on Behave
+"""
+# pylint: disable=W0403
+
+# __future__ has been added in order to maintain compatibility
+from __future__ import absolute_import, print_function
+
+import glob
+import json
+import logging
+import math
+import os
+import threading
+import time
+
+# Third-party imports
+try:
+    from filelock import FileLock
+    HAS_FILELOCK = True
+except ImportError:
+    HAS_FILELOCK = False
+
+from behavex_images.utils import file_utils
+
+# Folder (under the LOGS folder) where each process writes its metrics
+METRICS_FOLDER = 'image_attachments_metrics'
+
+# File (under the LOGS folder) with the metrics merged across all the processes
+METRICS_SUMMARY_FILENAME = 'image_attachments_metrics.json'
+
+# Number of histogram buckets per power of two, so the estimated percentiles are within 19% of the actual values
+_BUCKETS_PER_OCTAVE = 4
+
+_PERCENTILES = (50, 90, 99)
+
+_enabled = False
+_stages = {}
+_stages_lock = threading.Lock()
+
+
+def enable(enabled=True):
+    """
+    This function enables or disables the collection of metrics in the current process.
+
+    Parameters:
+    enabled (bool, optional): True to collect metrics, False otherwise. Defaults to True.
+
+    Returns:
+    None
+    """
+    global _enabled  # pylint: disable=global-statement
+    _enabled = enabled
+
+
+def is_enabled():
+    """Returns True if metrics are collected in the current process"""
+    return _enabled
+
+
+def start():
+    """
+    This function returns the start time of a measured stage, or None if metrics are disabled.
+
+    Returns:
+    float: The start time, to be provided to stop.
+    """
+    return time.perf_counter() if _enabled else None
+
+
+def stop(stage, started, bytes_in=0, bytes_out=0):
+    """
+    This function records the duration of a stage, measured since the given start time.
+
+    Parameters:
+    stage (str): The name of the measured stage.
+    started (float): The start time, as returned by start. Nothing is recorded if it is None.
+    bytes_in (int, optional): The number of bytes processed by the stage. Defaults to 0.
+    bytes_out (int, optional): The number of bytes produced by the stage. Defaults to 0.
+
+    Returns:
+    None
+    """
+    if started is None:
+        return
+    duration = time.perf_counter() - started
+    with _stages_lock:
+        stage_metrics = _stages.get(stage)
+        if stage_metrics is None:
+            stage_metrics = _stages[stage] = _new_stage_metrics()
+        stage_metrics['count'] += 1
+        stage_metrics['total'] += duration
+        stage_metrics['min'] = min(stage_metrics['min'], duration)
+        stage_metrics['max'] = max(stage_metrics['max'], duration)
+        stage_metrics['bytes_in'] += bytes_in
+        stage_metrics['bytes_out'] += bytes_out
+        bucket = str(_get_bucket(duration))
+        stage_metrics['buckets'][bucket] = stage_metrics['buckets'].get(bucket, 0) + 1
+
+
+def reset():
+    """Discards the metrics collected in the current process"""
+    with _stages_lock:
+        _stages.clear()
+
+
+def write_summary():
+    """
+    This function writes the metrics collected in the current process, and merges the metrics written by all the
+    processes into a JSON summary under the LOGS folder.
+
+    Returns:
+    str: The path of the JSON summary, or None if metrics are disabled or the LOGS environment variable is not set.
+    """
+    logs_env = os.getenv('LOGS')
+    if not _enabled or not logs_env:
+        return None
+    metrics_folder = os.path.join(logs_env, METRICS_FOLDER)
+    if not os.path.isdir(metrics_folder):
+        os.makedirs(metrics_folder, exist_ok=True)
+    with _stages_lock:
+        process_metrics = json.dumps({'pid': os.getpid(), 'stages': _stages})
+    # Each process writes its own file, with all the metrics collected since it started
+    file_utils.write_file_atomically(os.path.join(metrics_folder, 'metrics_%d.json' % os.getpid()),
+                                     process_metrics.encode('utf-8'))
+    summary_filename = os.path.join(logs_env, METRICS_SUMMARY_FILENAME)
+    if HAS_FILELOCK:
+        try:
+            with FileLock(metrics_folder + '.lock', timeout=30):
+                _write_merged_summary(metrics_folder, summary_filename)
+            return summary_filename
+        except Exception as exception:  # pylint: disable=broad-exception-caught
+            logging.error('[behavex-images] The metrics summary could not be written: %s' % str(exception))
+            return None
+    _write_merged_summary(metrics_folder, summary_filename)
+    return summary_filename
+
+
+def _write_merged_summary(metrics_folder, summary_filename):
+    """Merges the metrics written by all the processes, and writes the summary"""
+    merged_stages = {}
+    processes = 0
+    for metrics_filename in glob.glob(os.path.join(metrics_folder, 'metrics_*.json')):
+        try:
+            with open(metrics_filename) as metrics_file:
+                process_metrics = json.load(metrics_file)
+        except ValueError:
+            continue
+        processes += 1
+        for stage, stage_metrics in process_metrics['stages'].items():
+            merged_metrics = merged_stages.setdefault(stage, _new_stage_metrics())
+            merged_metrics['count'] += stage_metrics['count']
+            merged_metrics['total'] += stage_metrics['total']
+            merged_metrics['min'] = min(merged_metrics['min'], stage_metrics['min'])
+            merged_metrics['max'] = max(merged_metrics['max'], stage_metrics['max'])
+            merged_metrics['bytes_in'] += stage_metrics['bytes_in']
+            merged_metrics['bytes_out'] += stage_metrics['bytes_out']
+            for bucket, count in stage_metrics['buckets'].items():
+                merged_metrics['buckets'][bucket] = merged_metrics['buckets'].get(bucket, 0) + count
+    summary = {
+        'processes': processes,
+        'stages': {stage: _summarize(merged_stages[stage]) for stage in sorted(merged_stages)},
+    }
+    file_utils.write_file_atomically(summary_filename, json.dumps(summary, indent=2).encode('utf-8'))
+
+
+def _new_stage_metrics():
+    """Returns the initial metrics of a stage"""
+    return {'count': 0, 'total': 0.0, 'min': float('inf'), 'max': 0.0, 'bytes_in': 0, 'bytes_out': 0, 'buckets': {}}
+
+
+def _summarize(stage_metrics):
+    """Returns the summary of the metrics of a stage, with the latencies in milliseconds"""
+    count = stage_metrics['count']
+    summary = {
+        'count': count,
+        'total_ms': stage_metrics['total'] * 1000,
+        'mean_ms': stage_metrics['total'] * 1000 / count if count else 0.0,
+        'min_ms': stage_metrics['min'] * 1000 if count else 0.0,
+        'max_ms': stage_metrics['max'] * 1000,
+        'bytes_in': stage_metrics['bytes_in'],
+        'bytes_out': stage_metrics['bytes_out'],
+    }
+    buckets = sorted((int(bucket), bucket_count) for bucket, bucket_count in stage_metrics['buckets'].items())
+    for percentile in _PERCENTILES:
+        summary['p%d_ms' % percentile] = _get_percentile(buckets, count, percentile, stage_metrics['max']) * 1000
+    return summary
+
+
+def _get_bucket(duration):
+    """Returns the histogram bucket of a duration (in seconds), on a logarithmic scale of microseconds"""
+    microseconds = duration * 1000000
+    if microseconds <= 1:
+        return 0
+    return int(math.log2(microseconds) * _BUCKETS_PER_OCTAVE) + 1
+
+
+def _get_percentile(buckets, count, percentile, max_duration):
+    """Estimates a percentile (in seconds) from the histogram buckets, as the upper bound of the bucket containing it"""
+    if not count:
+        return 0.0
+    rank = math.ceil(count * percentile / 100.0)
+    cumulative_count = 0
+    for bucket, bucket_count in buckets:
+        cumulative_count += bucket_count
+        if cumulative_count >= rank:
+            upper_bound = 2 ** (float(bucket) / _BUCKETS_PER_OCTAVE) / 1000000
+            return min(upper_bound, max_duration)
+    return max_duration
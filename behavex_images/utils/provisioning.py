@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+"""
+BehaveX - BDD testing library based on Behave
+"""
+# pylint: disable=W0403
+
+# __future__ has been added in order to maintain compatibility
+from __future__ import absolute_import, print_function
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import time
+import uuid
+from enum import Enum
+
+# Third-party imports
+try:
+    from filelock import FileLock, Timeout
+    HAS_FILELOCK = True
+except ImportError:
+    HAS_FILELOCK = False
+
+from behavex_images.utils import file_utils
+
+# Folder (under the LOGS folder) where the gallery support files are provisioned
+SUPPORT_FILES_FOLDER = 'image_attachments_utils'
+
+# Marker written once the support files are provisioned, stamped with the package version and the files content hash
+COMPLETION_MARKER = '.copy_complete'
+
+# Maximum time (in seconds) a process waits for another process to provision the support files
+PROVISIONING_TIMEOUT = 60
+
+_SUPPORT_FILES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'support_files')
+_POLL_INTERVALS = (0.01, 0.02, 0.05, 0.1, 0.2, 0.5)
+_support_files_stamp = None
+
+
+class SupportFilesMode(Enum):
+    """Ways the gallery support files are provisioned in the output folder"""
+    COPY = 'copy'
+    HARDLINK = 'hardlink'
+    SYMLINK = 'symlink'
+
+
+def provision_support_files(logs_path, mode=SupportFilesMode.COPY):
+    """
+    This function provisions the gallery support files (scripts, styles and images) in the output folder.
+
+    The support files are copied, hard linked or symbolically linked from the installed package (falling back to a
+    copy when links are not supported). A completion marker, stamped with the package version and the content hash
+    of the support files, avoids provisioning them again, unless they changed (e.g. after upgrading the package).
+    When the `filelock` library is available, a single process provisions the files, while the others poll the marker.
+
+    Parameters:
+    logs_path (str): The path of the output folder.
+    mode (SupportFilesMode, optional): How the support files are provisioned. Defaults to SupportFilesMode.COPY.
+
+    Returns:
+    str: The path of the provisioned support files.
+    """
+    destination_path = os.path.join(logs_path, SUPPORT_FILES_FOLDER)
+    completion_marker = os.path.join(destination_path, COMPLETION_MARKER)
+    stamp = dict(_get_support_files_stamp(), mode=mode.value)
+    if _is_provisioned(completion_marker, stamp):
+        return destination_path
+    if not HAS_FILELOCK:
+        # Without a lock, several processes could provision the files at the same time, which is safe as every file is
+        # replaced atomically
+        _provision(destination_path, completion_marker, stamp, mode)
+        return destination_path
+
+    lock = FileLock(destination_path + '.lock')
+    deadline = time.time() + PROVISIONING_TIMEOUT
+    poll_count = 0
+    while time.time() < deadline:
+        try:
+            with lock.acquire(timeout=0):
+                # Re-check after acquiring the lock, as another process could have provisioned the files
+                if not _is_provisioned(completion_marker, stamp):
+                    _provision(destination_path, completion_marker, stamp, mode)
+                return destination_path
+        except Timeout:
+            # Another process is provisioning the files, so the marker is polled until it is written
+            time.sleep(_POLL_INTERVALS[min(poll_count, len(_POLL_INTERVALS) - 1)])
+            poll_count += 1
+            if _is_provisioned(completion_marker, stamp):
+                return destination_path
+    logging.warning('[behavex-images] Timed out waiting for the gallery support files, provisioning them anyway')
+    _provision(destination_path, completion_marker, stamp, mode)
+    return destination_path
+
+
+def _provision(destination_path, completion_marker, stamp, mode):
+    """Provisions every support file, and writes the completion marker"""
+    if not os.path.isdir(destination_path):
+        os.makedirs(destination_path, exist_ok=True)
+    for file_name in _get_support_file_names():
+        _provision_file(os.path.join(_SUPPORT_FILES_PATH, file_name), os.path.join(destination_path, file_name), mode)
+    marker = dict(stamp, version=_get_package_version())
+    file_utils.write_file_atomically(completion_marker, json.dumps(marker, sort_keys=True).encode('utf-8'))
+
+
+def _provision_file(source_file, destination_file, mode):
+    """Links or copies a support file to a temporary file, and renames it, so the files are replaced atomically"""
+    temp_file = '%s.%s.tmp' % (destination_file, uuid.uuid4().hex)
+    try:
+        try:
+            if mode == SupportFilesMode.HARDLINK:
+                os.link(source_file, temp_file)
+            elif mode == SupportFilesMode.SYMLINK:
+                os.symlink(source_file, temp_file)
+            else:
+                shutil.copy2(source_file, temp_file)
+        except (OSError, AttributeError, NotImplementedError):
+            # Links are not supported (e.g. across file systems, or without privileges on Windows)
+            shutil.copy2(source_file, temp_file)
+        os.replace(temp_file, destination_file)
+    except Exception:
+        if os.path.lexists(temp_file):
+            os.remove(temp_file)
+        raise
+
+
+def _is_provisioned(completion_marker, stamp):
+    """Returns True if the completion marker was written with the given stamp"""
+    try:
+        with open(completion_marker) as marker_file:
+            marker = json.load(marker_file)
+    except (OSError, ValueError):
+        return False
+    # The version is only informative, as the support files are refreshed only if their content changed
+    return isinstance(marker, dict) and all(marker.get(key) == value for key, value in stamp.items())
+
+
+def _get_support_file_names():
+    """Returns the names of the support files, excluding the Python files of the package"""
+    return sorted(file_name for file_name in os.listdir(_SUPPORT_FILES_PATH)
+                  if os.path.isfile(os.path.join(_SUPPORT_FILES_PATH, file_name))
+                  and not file_name.endswith(('.py', '.pyc')))
+
+
+def _get_support_files_stamp():
+    """Returns the content hash of the support files, computed once per process"""
+    global _support_files_stamp  # pylint: disable=global-statement
+    if _support_files_stamp is None:
+        content_hash = hashlib.blake2b(digest_size=16)
+        for file_name in _get_support_file_names():
+            content_hash.update(file_name.encode('utf-8') + b'\0')
+            with open(os.path.join(_SUPPORT_FILES_PATH, file_name), 'rb') as support_file:
+                content_hash.update(support_file.read())
+        _support_files_stamp = {'content_hash': content_hash.hexdigest()}
+    return _support_files_stamp
+
+
+def _get_package_version():
+    """Returns the installed version of behavex-images, or an empty string if it is not installed"""
+    try:
+        from importlib import metadata
+        return metadata.version('behavex-images')
+    except Exception:  # pylint: disable=broad-exception-caught
+        return ''
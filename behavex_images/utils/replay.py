@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+"""
+BehaveX - BDD testing library based on Behave
+"""
+# pylint: disable=W0403
+
+# __future__ has been added in order to maintain compatibility
+from __future__ import absolute_import, print_function
+
+import json
+import logging
+import os
+import struct
+import zlib
+from enum import Enum
+from fractions import Fraction
+from io import BytesIO
+
+from behavex_images.utils import file_utils, gallery, metrics
+
+# Name (without extension) of the animated replay created in the scenario images folder
+REPLAY_FILENAME = 'replay'
+
+# Name of the file with the timing and captions of each frame of the animated replay
+REPLAY_METADATA_FILENAME = 'replay.json'
+
+# Time (in milliseconds) each attached image is shown in the animated replay, unless configured otherwise
+DEFAULT_FRAME_DURATION = 1000
+
+# Background of the frames smaller than the animated replay
+_BACKGROUND_COLOR = (255, 255, 255, 255)
+
+_PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+
+class ReplayFormat(Enum):
+    """
+    This is an enumeration class that defines the format of the animated replay of a scenario.
+
+    Attributes:
+    APNG (str): The replay is an animated PNG (lossless).
+    WEBP (str): The replay is a lossless animated WebP.
+    """
+    APNG = "apng"
+    WEBP = "webp"
+
+
+_REPLAY_EXTENSIONS = {ReplayFormat.APNG: '.png', ReplayFormat.WEBP: '.webp'}
+
+
+def get_replay_path(folder, replay_format):
+    """
+    This function returns the path of the animated replay of a scenario.
+
+    Parameters:
+    folder (str): The path to the scenario images folder.
+    replay_format (ReplayFormat): The format of the animated replay.
+
+    Returns:
+    str: The path of the animated replay.
+    """
+    return os.path.join(folder, REPLAY_FILENAME + _REPLAY_EXTENSIONS[replay_format])
+
+
+def write_replay(folder, title, frames, replay_format=ReplayFormat.WEBP, frame_duration=DEFAULT_FRAME_DURATION,
+                 with_gallery=True):
+    """
+    This function encodes the images attached to a scenario into a single animated image, with a JSON file
+    describing the timing and captions of each frame, and optionally the HTML gallery showing the replay.
+
+    Frames are drawn on a canvas as large as the largest image, and only the region of each frame that differs from
+    the previous one is stored. The frames are decoded and written one at a time, so only the current and the previous
+    frames are held in memory. Errors are logged, as this function is executed by a worker thread.
+
+    Parameters:
+    folder (str): The path to the scenario images folder.
+    title (str): The title of the gallery.
+    frames (list): The frames of the replay, as tuples with the image key, a function returning the image binary,
+                   the captions of the image, and its size (width, height), or None if unknown.
+    replay_format (ReplayFormat, optional): The format of the animated replay. Defaults to ReplayFormat.WEBP.
+    frame_duration (int, optional): The time (in milliseconds) each frame is shown. Defaults to 1000.
+    with_gallery (bool, optional): True to write the HTML gallery showing the replay. Defaults to True.
+
+    Returns:
+    str: The path of the animated replay, or None if it could not be created.
+    """
+    if not frames:
+        return None
+    replay_started = metrics.start()
+    replay_path = get_replay_path(folder, replay_format)
+    try:
+        frame_sizes = [size or _read_image_size(get_image_binary()) for _, get_image_binary, _, size in frames]
+        replay_binary = _encode_replay([get_image_binary for _, get_image_binary, _, _ in frames], frame_sizes,
+                                       replay_format, frame_duration)
+        file_utils.write_file_atomically(replay_path, replay_binary)
+        replay_metadata = {
+            'format': replay_format.value,
+            'frame_duration': frame_duration,
+            'frames': [
+                {'key': key, 'start': index * frame_duration, 'size': frame_sizes[index], 'captions': list(captions or [])}
+                for index, (key, _, captions, _) in enumerate(frames)
+            ],
+        }
+        file_utils.write_file_atomically(os.path.join(folder, REPLAY_METADATA_FILENAME),
+                                         json.dumps(replay_metadata, indent=2).encode('utf-8'))
+        if with_gallery:
+            replay_captions = []
+            for index, (_, _, captions, _) in enumerate(frames):
+                replay_captions.append('[%d/%d - %s]<br>' % (index + 1, len(frames), _format_time(index * frame_duration)))
+                replay_captions.extend(captions or [])
+            gallery.write_gallery(folder, title, [gallery.render_gallery_entry(folder, replay_path, replay_captions)])
+    except Exception as exception:  # pylint: disable=broad-exception-caught
+        logging.error('[behavex-images] The animated replay could not be created: %s' % str(exception))
+        return None
+    metrics.stop('write_replay', replay_started, bytes_out=len(replay_binary))
+    return replay_path
+
+
+def _read_image_size(image_binary):
+    """Reads the size of an image from its header, without decoding it"""
+    from PIL import Image
+
+    with Image.open(BytesIO(image_binary)) as img:
+        return img.size
+
+
+def _encode_replay(frame_binaries, frame_sizes, replay_format, frame_duration):
+    """
+    Encodes the frames into an animated image, drawing them on a canvas as large as the largest frame.
+
+    The frames are decoded one at a time, when the encoder reaches them, so they are never held in memory all at once.
+    """
+    canvas_size = (max(width for width, _ in frame_sizes), max(height for _, height in frame_sizes))
+    if replay_format == ReplayFormat.APNG:
+        return _encode_apng_replay(frame_binaries, canvas_size, frame_duration)
+    return _encode_webp_replay(frame_binaries, canvas_size, frame_duration)
+
+
+def _encode_webp_replay(frame_binaries, canvas_size, frame_duration):
+    """
+    Encodes the frames into a lossless animated WebP with Pillow, which only stores the region of each frame that
+    changed since the previous one. The frames are given to Pillow as a multi-frame image that decodes each frame when
+    it is selected, as Pillow encodes the frames one at a time.
+    """
+    from PIL import Image
+
+    class FrameSequence(Image.Image):
+        """Multi-frame image that decodes each frame of the replay when it is selected"""
+
+        def __init__(self):
+            Image.Image.__init__(self)
+            self.n_frames = len(frame_binaries)
+            self.is_animated = self.n_frames > 1
+            self._frame_index = None
+            self.seek(0)
+
+        def seek(self, frame):
+            if frame != self._frame_index:
+                decoded_frame = _decode_frame(frame_binaries[frame](), canvas_size)
+                self.im, self._mode, self._size = decoded_frame.im, decoded_frame.mode, decoded_frame.size
+                self._frame_index = frame
+
+        def tell(self):
+            return self._frame_index
+
+    replay_binary_data = BytesIO()
+    FrameSequence().save(replay_binary_data, format='WEBP', save_all=True, duration=frame_duration, loop=0,
+                         lossless=True, minimize_size=True, background=_BACKGROUND_COLOR)
+    return replay_binary_data.getvalue()
+
+
+def _encode_apng_replay(frame_binaries, canvas_size, frame_duration):
+    """
+    Encodes the frames into an animated PNG, storing only the region of each frame that changed since the previous one.
+
+    Pillow keeps every frame in memory until the animated PNG is written, so the frames are appended one at a time by
+    _ApngWriter instead, and only the current and the previous frames are held in memory.
+    """
+    from PIL import ImageChops
+
+    replay_writer = _ApngWriter(len(frame_binaries), frame_duration)
+    previous_frame = None
+    for get_image_binary in frame_binaries:
+        frame = _decode_frame(get_image_binary(), canvas_size)
+        if previous_frame is None:
+            frame_box = (0, 0) + canvas_size
+        else:
+            # An unchanged frame only stores a single pixel
+            frame_box = ImageChops.difference(previous_frame, frame).getbbox() or (0, 0, 1, 1)
+        replay_writer.add_frame(frame, frame_box)
+        previous_frame = frame
+    return replay_writer.close()
+
+
+def _decode_frame(image_binary, canvas_size):
+    """Decodes an image binary into a frame of the animated replay, drawn on a canvas of the given size"""
+    from PIL import Image
+
+    with Image.open(BytesIO(image_binary)) as img:
+        if img.size == canvas_size:
+            return img.convert('RGB')
+        canvas = Image.new('RGB', canvas_size, _BACKGROUND_COLOR[:3])
+        canvas.paste(img.convert('RGB'), (0, 0))
+        return canvas
+
+
+class _ApngWriter(object):
+    """
+    Writer of an animated PNG, appending the frames one at a time.
+
+    Each frame region is encoded as a still PNG image by Pillow, whose image data chunks are written as the frame data.
+    """
+
+    def __init__(self, frames_count, frame_duration):
+        self._output = BytesIO()
+        self._output.write(_PNG_SIGNATURE)
+        self._frames_count = frames_count
+        delay = Fraction(frame_duration, 1000).limit_denominator(0xFFFF)
+        self._delay = (min(delay.numerator, 0xFFFF), delay.denominator)
+        self._sequence_number = 0
+
+    def add_frame(self, frame, frame_box):
+        """Appends the region of a frame within the given bounding box, drawn over the previous frame"""
+        frame_binary_data = BytesIO()
+        frame.crop(frame_box).save(frame_binary_data, format='PNG')
+        png_chunks = _read_png_chunks(frame_binary_data.getvalue())
+        if self._sequence_number == 0:
+            _write_png_chunk(self._output, b'IHDR', png_chunks[b'IHDR'][0])
+            _write_png_chunk(self._output, b'acTL', struct.pack('>II', self._frames_count, 0))
+        left, upper, right, lower = frame_box
+        # Frames replace the region they cover (APNG_DISPOSE_OP_NONE and APNG_BLEND_OP_SOURCE)
+        _write_png_chunk(self._output, b'fcTL', struct.pack('>IIIIIHHBB', self._next_sequence_number(), right - left,
+                                                            lower - upper, left, upper, self._delay[0], self._delay[1], 0, 0))
+        for image_data in png_chunks[b'IDAT']:
+            if self._sequence_number == 1:
+                # The first frame is also the default image, written as regular image data
+                _write_png_chunk(self._output, b'IDAT', image_data)
+            else:
+                _write_png_chunk(self._output, b'fdAT', struct.pack('>I', self._next_sequence_number()) + image_data)
+
+    def close(self):
+        """Finishes the animated PNG, and returns its binary"""
+        _write_png_chunk(self._output, b'IEND', b'')
+        return self._output.getvalue()
+
+    def _next_sequence_number(self):
+        sequence_number = self._sequence_number
+        self._sequence_number += 1
+        return sequence_number
+
+
+def _read_png_chunks(png_binary):
+    """Returns the payloads of the chunks of a PNG image, by chunk type"""
+    png_chunks = {}
+    position = len(_PNG_SIGNATURE)
+    while position < len(png_binary):
+        length, chunk_type = struct.unpack('>I4s', png_binary[position:position + 8])
+        png_chunks.setdefault(chunk_type, []).append(png_binary[position + 8:position + 8 + length])
+        position += 12 + length
+    return png_chunks
+
+
+def _write_png_chunk(output, chunk_type, payload):
+    """Writes a PNG chunk, with its length and CRC"""
+    output.write(struct.pack('>I', len(payload)) + chunk_type + payload +
+                 struct.pack('>I', zlib.crc32(chunk_type + payload) & 0xFFFFFFFF))
+
+
+def _format_time(milliseconds):
+    """Formats a time of the replay as minutes, seconds and tenths of a second"""
+    seconds, milliseconds = divmod(milliseconds, 1000)
+    return '%02d:%02d.%d' % (seconds // 60, seconds % 60, milliseconds // 100)
@@ -9,144 +9,456 @@ from __future__ import absolute_import, print_function
 
 import os
 import re
+import shutil
+import threading
 import logging
+import uuid
+from collections import namedtuple
+from functools import partial
 from enum import Enum
-import xml.etree.ElementTree as ET
+from io import BytesIO
 
+from behavex_images.utils import delta_frames, executors, file_utils, gallery, hash_cache, image_store, metrics, replay
 
-def create_gallery(folder, title='BehaveX', captions={}):
+# Number of threads used to write the images of a scenario to disk, unless configured otherwise
+DEFAULT_DUMP_WORKERS = 4
+
+# Size (in pixels) of the square the gallery thumbnails fit in, unless configured otherwise
+DEFAULT_THUMBNAIL_SIZE = 250
+
+# Extensions of the image files included in the gallery, when listing the images folder
+GALLERY_IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.webp')
+
+# Pattern of the log lines that describe a step, compiled once as it is applied to every captured log line
+_STEP_LOG_PATTERN = re.compile(r'(given|when|then) \"(?P<step>.*)\"', re.MULTILINE)
+
+# Result of dumping the images of a scenario to disk
+DumpResult = namedtuple('DumpResult', ['written', 'failed'])
+
+
+def create_gallery(folder, title='BehaveX', captions={}, images=None, thumbnails=None):
     """
     This function creates an HTML gallery of images from a specified folder.
 
+    The gallery is rendered from the images written to disk (see dump_images_to_disk), so the folder is only
+    listed when no images are provided.
+
     Parameters:
     folder (str): The path to the folder containing the images.
     title (str, optional): The title of the gallery. Defaults to 'BehaveX'.
     captions (dict, optional): A dictionary where the keys are the image filenames (without extension) and the values are the captions for the images. Defaults to an empty dictionary.
+    images (dict, optional): A dictionary where the keys are the image filenames (without extension) and the values are the image paths. Defaults to None, to include all the images found in the folder.
+    thumbnails (dict, optional): A dictionary where the keys are the image filenames (without extension) and the values are the thumbnails shown in the gallery (see create_thumbnails). Defaults to None, to show the images.
 
     Returns:
     None
     """
-    root = ET.Element('html', {'class': 'gallery-html'})
-    head = ET.SubElement(root, 'head')
-    script = ET.SubElement(
-        head, 'script', {'type': 'text/javascript', 'charset': 'utf-8'}
-    )
-    script.text = ' '
-    script = ET.SubElement(
-        head,
-        'script',
-        {
-            'src': '../image_attachments_utils/jquery-1.11.0.' 'min.js',
-            'type': 'text/javascript',
-        },
-    )
-    script.text = ' '
-    script = ET.SubElement(
-        head,
-        'script',
-        {'src': '../image_attachments_utils/lightbox.js', 'type': 'text/javascript'},
-    )
-    script.text = ' '
-    ET.SubElement(
-        head, 'link', {'rel': 'stylesheet', 'href': '../image_attachments_utils/lightbox.css'}
-    )
-    ET.SubElement(
-        head, 'link', {'href': '../../bootstrap/css/bootstrap.min.css', 'rel': 'stylesheet'}
-    )
-    # Add custom CSS for lightbox
-    ET.SubElement(
-        head, 'link', {'href': '../image_attachments_utils/behavex.css', 'rel': 'stylesheet'}
-    )
-    head_title = ET.SubElement(head, 'title')
-    head_title.text = title
-    body = ET.SubElement(root, 'body', {'class': 'gallery-body'})
-    body_title = ET.SubElement(
-        body,
-        'h1',
-        {'class': 'gallery-title'}
-    )
-    body_title.text = title
+    gallery_started = metrics.start()
     folder = os.path.abspath(folder)
-
-    container = ET.SubElement(body, 'div', {'class': 'gallery-container'})
-    create_gallery_html_file(captions, container, folder, root)
+    thumbnails = thumbnails or {}
+    if images is None:
+        images = {os.path.splitext(file_)[0]: file_ for file_ in os.listdir(folder)
+                  if file_.lower().endswith(GALLERY_IMAGE_EXTENSIONS)}
+    if not images:
+        return
+    entries = [gallery.render_gallery_entry(folder, images[key], captions.get(key), thumbnails.get(key))
+               for key in sorted(images)]
+    gallery.write_gallery(folder, title, entries)
+    metrics.stop('create_gallery', gallery_started)
 
 
-def create_gallery_html_file(captions, container, folder, root):
+def dump_images_to_disk(context, on_image_written=None):
     """
-    This function creates an HTML file that contains all the images in a specified folder.
+    This function dumps all the images stored in the context object to the disk.
+
+    The images are written concurrently by a thread pool (see set_dump_workers), to a temporary file that is renamed
+    once completely written. If the content-addressable image store is enabled, each image is stored once per execution
+    in the image store, and it is hard linked to its expected location. If hard links are not supported, the image in the
+    store is referenced instead (or copied, when a formatter requires the images to be next to the report files).
 
     Parameters:
-    captions (dict): A dictionary where the keys are the image filenames (without extension) and the values are the captions for the images.
-    container (Element): The parent element in the HTML structure where the images will be added.
-    folder (str): The path to the folder containing the images.
-    root (Element): The root element of the HTML structure.
+    context (object): The context object which contains the images to be dumped.
+    on_image_written (callable, optional): A function called with the image filename (without extension) and the path
+                                           of the written image, as soon as each image is written. Defaults to None.
 
     Returns:
-    None
+    DumpResult: The images written to disk (a dictionary where the keys are the image filenames without extension,
+                and the values are the paths of the written images), and the images that could not be written
+                (a dictionary where the values are the error messages).
     """
-    pictures_found = False
-    for file_ in sorted(os.listdir(folder)):
-        if file_.endswith('.png'):
-            file_name = os.path.splitext(file_)[0]
-            img_caption = u''
-            if file_name in captions:
-                for caption in captions[file_name]:
-                    # Try and except structure to maintain compatibility decode cant be used with a string on python3
-                    # noinspection PyBroadException
-                    try:
-                        img_caption = img_caption + caption.decode('utf8')
-                    except:
-                        img_caption = img_caption + str(caption)
-            link = ET.SubElement(
-                container,
-                'a',
-                {
-                    'href': file_,
-                    'data-lightbox': 'lightbox-test-results',
-                    'data-title': img_caption,
-                },
-            )
-            ET.SubElement(
-                link,
-                'img',
-                {
-                    'src': file_,
-                    'class': 'gallery-image'
-                },
-            )
-            pictures_found = True
-    if pictures_found:
-        tree = ET.ElementTree(root)
-        # unicode has been changed to binary
-        with open(os.path.join(os.path.abspath(folder), 'images.html'), 'wb') as html_gallery:
-            html_gallery.write(b'<!DOCTYPE html>')
-            tree.write(html_gallery)
-
-
-def dump_images_to_disk(context):
+    # Internal utility function - log but don't crash if context is None
+    if context is None:
+        logging.warning('[behavex-images] dump_images_to_disk called with None context - no images to dump')
+        return DumpResult({}, {})
+        
+    apply_delta_encodings(context, wait=True)
+    attached_images = getattr(context, 'bhximgs_attached_images', {})
+    if not attached_images:
+        return DumpResult({}, {})
+    dump_started = metrics.start()
+    use_image_store = getattr(context, 'bhximgs_image_store', False)
+    copy_if_not_linked = bool(getattr(context, 'bhximgs_formatter', None))
+    dump_workers = getattr(context, 'bhximgs_dump_workers', DEFAULT_DUMP_WORKERS)
+    decoded_keyframes = DecodedKeyframes(attached_images.values())
+    futures = {}
+    if dump_workers > 1 and len(attached_images) > 1:
+        dump_executor = executors.get_executor('dump', dump_workers)
+        for key in attached_images:
+            futures[key] = dump_executor.submit(_dump_image, attached_images[key], use_image_store, copy_if_not_linked,
+                                                decoded_keyframes)
+    dump_result = DumpResult({}, {})
+    for key in attached_images:
+        try:
+            if key in futures:
+                dump_result.written[key] = futures[key].result()
+            else:
+                dump_result.written[key] = _dump_image(attached_images[key], use_image_store, copy_if_not_linked,
+                                                       decoded_keyframes)
+        except Exception as exception:
+            dump_result.failed[key] = str(exception)
+            logging.error('[behavex-images] The image could not be written to disk: %s' % str(exception))
+            continue
+        if on_image_written:
+            on_image_written(key, dump_result.written[key])
+    if dump_started is not None:
+        metrics.stop('dump_images_to_disk', dump_started,
+                     bytes_out=sum(len(attached_images[key]['img_stream'] or b'') for key in dump_result.written))
+    return dump_result
+
+
+def dump_images_to_gallery(context, title='BehaveX'):
     """
-    This function dumps all the images stored in the context object to the disk.
+    This function dumps all the images stored in the context object to the disk, appending each image to the
+    HTML gallery of the scenario as soon as it is written, instead of creating the gallery once all the images are written.
 
     Parameters:
     context (object): The context object which contains the images to be dumped.
+    title (str, optional): The title of the gallery. Defaults to 'BehaveX'.
+
+    Returns:
+    DumpResult: The images written to disk, and the images that could not be written (see dump_images_to_disk).
+    """
+    captions = get_captions(context)
+    attached_images_folder = getattr(context, 'bhximgs_attached_images_folder', None)
+    if not attached_images_folder:
+        return dump_images_to_disk(context)
+
+    with gallery.GalleryWriter(attached_images_folder, title) as gallery_writer:
+        def append_to_gallery(key, image_path):
+            thumbnail = create_thumbnails(context, {key: image_path}).get(key)
+            gallery_writer.append(image_path, captions.get(key), thumbnail)
+        return dump_images_to_disk(context, on_image_written=append_to_gallery)
+
+
+def dump_images_to_replay(context, title='BehaveX', with_gallery=True):
+    """
+    This function encodes all the images stored in the context object into a single animated image (see set_animated_replay),
+    instead of writing each image to disk.
+
+    The animated replay is created by a worker thread, so this function returns without waiting for it. The images
+    spilled to disk are read before returning, as they are removed when the scenario finishes.
+
+    Parameters:
+    context (object): The context object which contains the images to be encoded.
+    title (str, optional): The title of the gallery. Defaults to 'BehaveX'.
+    with_gallery (bool, optional): True to write the HTML gallery showing the replay. Defaults to True.
+
+    Returns:
+    DumpResult: The animated replay (with the 'replay' key), and no failed images, as errors are logged by the worker thread.
+    """
+    apply_delta_encodings(context, wait=True)
+    attached_images = getattr(context, 'bhximgs_attached_images', {})
+    attached_images_folder = getattr(context, 'bhximgs_attached_images_folder', None)
+    if not attached_images or not attached_images_folder:
+        return DumpResult({}, {})
+    replay_format = context.bhximgs_replay_format
+    decoded_keyframes = DecodedKeyframes(attached_images.values())
+    frames = []
+    for key in sorted(attached_images):
+        attached_image = attached_images[key]
+        if attached_image.get('spill_path'):
+            with open(attached_image['spill_path'], 'rb') as image_file:
+                attached_image = dict(attached_image, img_stream=image_file.read(), spill_path=None)
+        frames.append((key, partial(get_image_binary, attached_image, decoded_keyframes), attached_image['steps'],
+                       attached_image.get('size')))
+    replay_executor = executors.get_executor('replay', 1)
+    replay_executor.submit(replay.write_replay, attached_images_folder, title, frames, replay_format,
+                           getattr(context, 'bhximgs_replay_frame_duration', replay.DEFAULT_FRAME_DURATION),
+                           with_gallery)
+    return DumpResult({'replay': replay.get_replay_path(attached_images_folder, replay_format)}, {})
+
+
+def get_image_binary(attached_image, decoded_keyframes=None):
+    """
+    This function returns the binary of an attached image, reading it from disk if it was spilled, and rebuilding it
+    from its keyframe if it was delta encoded.
+
+    Parameters:
+    attached_image (dict): The attached image, as stored in the context object.
+    decoded_keyframes (DecodedKeyframes, optional): The keyframes decoded for the images being rebuilt, so each keyframe
+                                                    is decoded once. Defaults to None, to decode the keyframe of the image.
+
+    Returns:
+    bytes: The image binary.
+    """
+    image_binary = attached_image['img_stream']
+    if attached_image.get('spill_path'):
+        with open(attached_image['spill_path'], 'rb') as image_file:
+            image_binary = image_file.read()
+    delta_keyframe = attached_image.get('delta_keyframe')
+    if delta_keyframe is not None:
+        # Delta encoded images are rebuilt from their keyframe, which is never spilled to disk
+        if decoded_keyframes is None:
+            return delta_frames.rebuild_frame(delta_frames.decode_frame(delta_keyframe['img_stream']), image_binary,
+                                              attached_image['delta_offset'])
+        try:
+            image_binary = delta_frames.rebuild_frame(decoded_keyframes.get(delta_keyframe), image_binary,
+                                                      attached_image['delta_offset'])
+        finally:
+            decoded_keyframes.release(delta_keyframe)
+    return image_binary
+
+
+class DecodedKeyframes(object):
+    """
+    Keyframes decoded to rebuild the delta encoded images (see set_delta_encoding), shared by the threads writing them.
+
+    Each keyframe is decoded when the first of its delta encoded images is rebuilt, and it is released once all of them
+    are rebuilt, so the keyframe is decoded once and only the keyframes of the images being written are held in memory.
+    """
+
+    def __init__(self, attached_images):
+        self._pending_images = {}
+        for attached_image in attached_images:
+            delta_keyframe = attached_image.get('delta_keyframe')
+            if delta_keyframe is not None:
+                self._pending_images[id(delta_keyframe)] = self._pending_images.get(id(delta_keyframe), 0) + 1
+        self._frames = {}
+        self._lock = threading.Lock()
+
+    def get(self, keyframe_image):
+        """Returns the decoded keyframe, decoding it if needed"""
+        with self._lock:
+            frame_holder = self._frames.setdefault(id(keyframe_image), {'lock': threading.Lock(), 'frame': None})
+        # Each keyframe is decoded while holding its own lock, so the other keyframes can be decoded concurrently
+        with frame_holder['lock']:
+            if frame_holder['frame'] is None:
+                frame_holder['frame'] = delta_frames.decode_frame(keyframe_image['img_stream'])
+            return frame_holder['frame']
+
+    def release(self, keyframe_image):
+        """Releases the decoded keyframe, once all its delta encoded images are rebuilt"""
+        with self._lock:
+            self._pending_images[id(keyframe_image)] = self._pending_images.get(id(keyframe_image), 1) - 1
+            if self._pending_images[id(keyframe_image)] <= 0:
+                self._frames.pop(id(keyframe_image), None)
+
+
+def _dump_image(attached_image, use_image_store, copy_if_not_linked, decoded_keyframes=None):
+    """
+    Writes an attached image to disk.
+
+    Returns the path where the image can be found, and raises an exception if it could not be written.
+    """
+    output_filename = attached_image['name']
+    spill_path = attached_image.get('spill_path')
+    if spill_path and not use_image_store and attached_image.get('delta_keyframe') is None:
+        # Images spilled to disk are moved into place instead of being written again
+        _move_spilled_image(spill_path, output_filename)
+        return output_filename
+    image_binary = get_image_binary(attached_image, decoded_keyframes)
+    if use_image_store:
+        image_path = _store_and_link_image(attached_image, image_binary, copy_if_not_linked)
+        if image_path:
+            return image_path
+    file_utils.write_file_atomically(output_filename, image_binary)
+    return output_filename
+
+
+def spill_images_to_disk(context):
+    """
+    This function keeps the memory held by the attached images within the budget configured in the context object.
+
+    When the size of the image binaries held in memory exceeds the budget, the oldest images are written to a temporary
+    folder under the scenario log path, and only their path is kept in memory. Images pending to be processed are spilled
+    after the images already added to the report story.
+
+    Parameters:
+    context (object): The context object which contains the images and the memory budget.
 
     Returns:
     None
     """
-    # Internal utility function - log but don't crash if context is None
-    if context is None:
-        logging.warning('[behavex-images] dump_images_to_disk called with None context - no images to dump')
+    memory_budget = getattr(context, 'bhximgs_memory_budget', None)
+    if memory_budget is None:
         return
-        
-    attached_images = getattr(context, 'bhximgs_attached_images', {})
-    if not attached_images:
+    apply_delta_encodings(context)
+    # The images being delta encoded are not spilled, as they could become keyframes
+    held_images = [(attached_image, 'img_stream')
+                   for attached_image in getattr(context, 'bhximgs_attached_images', {}).values()
+                   if 'delta_future' not in attached_image]
+    held_images.extend((pending_image, 'img_binary')
+                       for pending_image in getattr(context, 'bhximgs_pending_images', [])
+                       if 'future' not in pending_image)
+    held_bytes = sum(len(held_image[binary_key] or b'') for held_image, binary_key in held_images)
+    if held_bytes <= memory_budget:
         return
-    for key in attached_images:
-        write_image_binary_to_file(
-            attached_images[key]['name'],
-            attached_images[key]['img_stream'],
-        )
+    spill_folder = get_spill_folder(context)
+    if not spill_folder:
+        return
+    if not os.path.isdir(spill_folder):
+        os.makedirs(spill_folder, exist_ok=True)
+    for held_image, binary_key in held_images:
+        if held_bytes <= memory_budget:
+            break
+        image_binary = held_image[binary_key]
+        # Keyframes of delta encoded images are not spilled, as they are needed to rebuild the following images
+        if not image_binary or held_image.get('keyframe'):
+            continue
+        spill_path = held_image.get('spill_path') or os.path.join(spill_folder, uuid.uuid4().hex)
+        if not write_image_binary_to_file(spill_path, image_binary):
+            logging.warning('[behavex-images] The image could not be spilled to disk: %s' % spill_path)
+            return
+        held_image['spill_path'] = spill_path
+        held_image[binary_key] = None
+        held_bytes -= len(image_binary)
+
+
+def get_spill_folder(context):
+    """
+    This function returns the temporary folder where the images exceeding the memory budget are written.
+
+    Parameters:
+    context (object): The context object which contains the scenario log path.
+
+    Returns:
+    str: The path of the temporary folder, or None if the scenario log path is not available.
+    """
+    attached_images_folder = getattr(context, 'bhximgs_attached_images_folder', None)
+    if not attached_images_folder:
+        return None
+    return os.path.join(attached_images_folder, '.image_attachments_spill')
+
+
+def remove_spilled_images(context):
+    """
+    This function removes the images spilled to disk that were not moved to their final location.
+
+    Parameters:
+    context (object): The context object which contains the scenario log path.
+
+    Returns:
+    None
+    """
+    spill_folder = get_spill_folder(context)
+    if spill_folder and os.path.isdir(spill_folder):
+        shutil.rmtree(spill_folder, ignore_errors=True)
+
+
+def _move_spilled_image(spill_path, output_filename):
+    """Moves an image spilled to disk to its final location"""
+    try:
+        os.replace(spill_path, output_filename)
+    except OSError:
+        # The final location could be in another file system
+        shutil.move(spill_path, output_filename)
+
+
+def _store_and_link_image(attached_image, image_binary, copy_if_not_linked):
+    """
+    Stores an image in the run-wide image store and hard links it to the output filename.
+    If the image was not found in the shared hash cache when attached, it is recorded in it.
+
+    Returns the path where the image can be found, or None if the image store could not be used.
+    """
+    output_filename = attached_image['name']
+    try:
+        object_path = image_store.store_image(image_binary, os.path.splitext(output_filename)[1])
+    except (IOError, OSError) as exception:
+        logging.warning('[behavex-images] The image could not be added to the image store: %s' % str(exception))
+        return None
+    if not object_path:
+        return None
+    if attached_image.get('cache_key'):
+        hash_cache.record(attached_image['cache_key'], attached_image.get('hash'), os.path.splitext(object_path)[1],
+                          attached_image.get('size'), object_path)
+    if image_store.link_image(object_path, output_filename):
+        return output_filename
+    if copy_if_not_linked:
+        return None
+    return object_path
+
+
+def create_thumbnails(context, images):
+    """
+    This function creates the thumbnails shown in the gallery for the images written to disk.
+
+    If thumbnails are enabled in the context object, they are created concurrently by a thread pool, and written to the
+    'thumbnails' folder next to the images. Otherwise, the images themselves are used as thumbnails, and only their
+    display size is computed.
+
+    Parameters:
+    context (object): The context object which contains the images and the thumbnails configuration.
+    images (dict): A dictionary where the keys are the image filenames (without extension) and the values are the paths of the images written to disk.
+
+    Returns:
+    dict: A dictionary where the keys are the image filenames (without extension) and the values are dictionaries with the thumbnail path ('src'), width and height.
+    """
+    attached_images = getattr(context, 'bhximgs_attached_images', {})
+    thumbnail_size = getattr(context, 'bhximgs_thumbnail_size', None)
+    attached_images_folder = getattr(context, 'bhximgs_attached_images_folder', None)
+    thumbnails = {}
+    if not thumbnail_size or not attached_images_folder:
+        for key in images:
+            image_size = attached_images.get(key, {}).get('size')
+            if image_size:
+                width, height = _get_thumbnail_size(image_size, DEFAULT_THUMBNAIL_SIZE)
+                thumbnails[key] = {'src': images[key], 'width': width, 'height': height}
+        return thumbnails
+    thumbnails_folder = os.path.join(attached_images_folder, 'thumbnails')
+    if not os.path.isdir(thumbnails_folder):
+        os.makedirs(thumbnails_folder, exist_ok=True)
+    dump_executor = executors.get_executor('dump', getattr(context, 'bhximgs_dump_workers', DEFAULT_DUMP_WORKERS))
+    futures = {}
+    for key in images:
+        # Thumbnails are created from the images in memory when available, to avoid reading them back from disk
+        attached_image = attached_images.get(key, {})
+        image = images[key] if attached_image.get('delta_keyframe') else attached_image.get('img_stream') or images[key]
+        thumbnail_path = os.path.join(thumbnails_folder, key + '.jpg')
+        futures[key] = (thumbnail_path, dump_executor.submit(_create_thumbnail, image, thumbnail_path, thumbnail_size))
+    for key, (thumbnail_path, future) in futures.items():
+        try:
+            width, height = future.result()
+            thumbnails[key] = {'src': thumbnail_path, 'width': width, 'height': height}
+        except Exception as exception:
+            logging.warning('[behavex-images] The thumbnail could not be created: %s' % str(exception))
+    return thumbnails
+
+
+def _create_thumbnail(image, thumbnail_path, thumbnail_size):
+    """
+    Creates a JPEG thumbnail that fits in a square of the given size, from an image binary or file path.
+
+    Returns the size (width, height) of the thumbnail.
+    """
+    from PIL import Image
+
+    with Image.open(BytesIO(image) if isinstance(image, bytes) else image) as img:
+        # Image.thumbnail uses the JPEG draft mode and a reducing gap, so large images are downscaled fast
+        img.thumbnail((thumbnail_size, thumbnail_size), reducing_gap=2.0)
+        if img.mode not in ('L', 'RGB'):
+            img = img.convert('RGB')
+        thumbnail_binary_data = BytesIO()
+        img.save(thumbnail_binary_data, format='JPEG', quality=80)
+    file_utils.write_file_atomically(thumbnail_path, thumbnail_binary_data.getvalue())
+    return img.size
+
+
+def _get_thumbnail_size(image_size, thumbnail_size):
+    """Returns the size of an image scaled down to fit in a square of the given size, keeping its aspect ratio"""
+    width, height = image_size
+    scale = min(1.0, float(thumbnail_size) / max(width, height, 1))
+    return max(1, int(round(width * scale))), max(1, int(round(height * scale)))
 
 
 def get_captions(context):
@@ -182,8 +494,7 @@ def normalize_log(log_line, line_breaks=1):
     str: The normalized log line.
     """
     log_line = log_line.replace('\0', '')
-    pattern = re.compile(r'(given|when|then) \"(?P<step>.*)\"', re.MULTILINE)
-    line = pattern.search(log_line)
+    line = _STEP_LOG_PATTERN.search(log_line)
     if line is not None:
         step = line.group('step')
     else:
@@ -202,18 +513,19 @@ def add_image_to_report_story(context):
     context (object): The context object which contains various attributes used in the function, including the image stream.
     
     Returns:
-    None
+    str: The key of the image added to the report story, or None if there was no image to add.
     """
     # Internal utility function - log but don't crash if context is None
     if context is None:
         logging.warning('[behavex-images] add_image_to_report_story called with None context - cannot add image to story')
-        return
+        return None
         
     image_stream = getattr(context, 'bhximgs_image_stream', None)
     if image_stream:
         step_line = getattr(context, 'bhximgs_current_step_line', 0)
         images_idx = getattr(context, 'bhximgs_attached_images_idx', 0)
         key = f"{str(step_line).zfill(5)}{str(images_idx).zfill(5)}"
+        image_extension = getattr(context, 'bhximgs_image_extension', None) or '.png'
         
         # Check if formatter is specified in context
         formatter = getattr(context, 'bhximgs_formatter', None)
@@ -221,11 +533,11 @@ def add_image_to_report_story(context):
             # Extract scenario hash from the log_path (which is the scenario directory)
             attached_images_folder = getattr(context, 'bhximgs_attached_images_folder', '')
             scenario_hash = os.path.basename(attached_images_folder)
-            name = os.path.join(os.getenv('LOGS'), f"{scenario_hash}_{key}.png")
+            name = os.path.join(os.getenv('LOGS'), f"{scenario_hash}_{key}{image_extension}")
         else:
             # Original behavior - save in scenario folder
             attached_images_folder = getattr(context, 'bhximgs_attached_images_folder', '')
-            name = os.path.join(attached_images_folder, key) + '.png'
+            name = os.path.join(attached_images_folder, key) + image_extension
             
         # Ensure the attached_images dict exists
         if not hasattr(context, 'bhximgs_attached_images'):
@@ -236,13 +548,90 @@ def add_image_to_report_story(context):
             'img_stream': image_stream,
             'name': name,
             'steps': previous_steps[:],
+            'size': getattr(context, 'bhximgs_image_size', None),
+            'hash': getattr(context, 'bhximgs_image_hash', None),
+            'cache_key': getattr(context, 'bhximgs_image_cache_key', None),
         }
+        if getattr(context, 'bhximgs_delta_encoding', False) and image_extension == '.png':
+            _delta_encode_image(context, context.bhximgs_attached_images[key])
+        return key
+    return None
+
+
+def _delta_encode_image(context, attached_image):
+    """
+    Submits the delta encoding of an attached image to a worker thread (see _get_delta_encoding), so the image is not
+    decoded by the step thread. The result is applied to the image by apply_delta_encodings.
+
+    The keyframe of the scenario is kept in a holder in the context object, which is only updated by the worker
+    thread, as the images are delta encoded in the order they were attached.
+    """
+    apply_delta_encodings(context)
+    delta_keyframe = getattr(context, 'bhximgs_delta_keyframe', None)
+    if delta_keyframe is None:
+        delta_keyframe = context.bhximgs_delta_keyframe = {'image': None}
+    delta_executor = executors.get_executor('delta', 1)
+    attached_image['delta_future'] = delta_executor.submit(_get_delta_encoding, delta_keyframe, attached_image,
+                                                           attached_image['img_stream'])
+
+
+def _get_delta_encoding(delta_keyframe, attached_image, image_binary):
+    """
+    Computes the patch of the region of an attached image that changed since the keyframe (the last image kept in
+    full), so consecutive screenshots only hold their changed region in memory. Only the encoded keyframe is kept,
+    and it is decoded again for each image, so no decoded image is held between two attached images.
+
+    Returns the patch binary, the keyframe and the offset of the patch, or None if the image is kept in full, becoming
+    the new keyframe, as it cannot be stored as a patch of the keyframe.
+    """
+    delta_started = metrics.start()
+    keyframe_image = delta_keyframe['image']
+    frame = delta_frames.decode_frame(image_binary)
+    patch_box = None
+    if keyframe_image is not None:
+        patch_box = delta_frames.get_patch_box(delta_frames.decode_frame(keyframe_image['img_stream']), frame)
+    patch_binary = delta_frames.encode_patch(frame, patch_box) if patch_box else None
+    if patch_binary is None or len(patch_binary) >= len(image_binary):
+        delta_keyframe['image'] = attached_image
+        metrics.stop('delta_encode', delta_started, bytes_in=len(image_binary), bytes_out=len(image_binary))
+        return None
+    metrics.stop('delta_encode', delta_started, bytes_in=len(image_binary), bytes_out=len(patch_binary))
+    return patch_binary, keyframe_image, patch_box[:2]
+
+
+def apply_delta_encodings(context, wait=False):
+    """
+    This function applies the delta encoding computed by the worker thread to the attached images.
+
+    Parameters:
+    context (object): The context object which contains the attached images.
+    wait (bool, optional): True to wait for the images still being delta encoded. Defaults to False.
+
+    Returns:
+    None
+    """
+    for attached_image in list(getattr(context, 'bhximgs_attached_images', {}).values()):
+        delta_future = attached_image.get('delta_future')
+        if delta_future is None or not (wait or delta_future.done()):
+            continue
+        del attached_image['delta_future']
+        try:
+            delta_encoding = delta_future.result()
+        except Exception as exception:  # pylint: disable=broad-exception-caught
+            logging.warning('[behavex-images] The image could not be delta encoded: %s' % str(exception))
+            continue
+        if delta_encoding is None:
+            attached_image['keyframe'] = True
+        else:
+            attached_image['img_stream'], attached_image['delta_keyframe'], attached_image['delta_offset'] = delta_encoding
 
 
 def write_image_binary_to_file(output_filename, image_binary):
     """
     This function writes an image binary to a file.
 
+    The image binary is written to a temporary file that is renamed once completely written.
+
     Parameters:
     output_filename (str): The name of the output file where the image binary will be written.
     image_binary (bytes): The image binary to be written to the file.
@@ -251,8 +640,7 @@ def write_image_binary_to_file(output_filename, image_binary):
     bool: True if the image binary was successfully written to the file, False otherwise.
     """
     try:
-        with open(output_filename, 'wb') as image_file:
-            image_file.write(image_binary)
-    except IOError:
+        file_utils.write_file_atomically(output_filename, image_binary)
+    except (IOError, OSError):
         return False
     return True
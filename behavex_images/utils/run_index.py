@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+"""
+BehaveX - BDD testing library based on Behave
+"""
+# pylint: disable=W0403
+
+# __future__ has been added in order to maintain compatibility
+from __future__ import absolute_import, print_function
+
+import glob
+import json
+import logging
+import os
+import time
+from string import Template
+
+# Third-party imports
+try:
+    from filelock import FileLock
+    HAS_FILELOCK = True
+except ImportError:
+    HAS_FILELOCK = False
+
+from behavex_images.utils import file_utils, gallery
+
+# Folder (under the LOGS folder) where the run-level image index is created
+RUN_INDEX_FOLDER = 'image_attachments_index'
+
+# Number of images shown in each page of the run-level image index, unless configured otherwise
+DEFAULT_PAGE_SIZE = 500
+
+_MANIFEST_PATTERN = 'manifest_*.jsonl'
+# File with the state of the index when it was last built, so the next build only adds the new manifests
+_INDEX_STATE_FILENAME = 'index_state.json'
+_SCENARIO_HEADING = Template('<h2 class="gallery-title">$scenario <small>$status</small></h2>')
+_PAGE_LINK = Template('<a href="$href">$page</a>')
+_CURRENT_PAGE = Template('<strong>$page</strong>')
+_PAGES_NAVIGATION = Template('<nav class="gallery-pages">$links</nav>')
+
+
+def get_run_index_path():
+    """
+    This function returns the path of the run-level image index.
+
+    Returns:
+    str: The path of the run-level image index, or None if the LOGS environment variable is not set.
+    """
+    logs_env = os.getenv('LOGS')
+    if not logs_env:
+        return None
+    return os.path.join(logs_env, RUN_INDEX_FOLDER)
+
+
+def append_scenario_manifest(scenario_name, status, images, captions=None, hashes=None):
+    """
+    This function appends the manifest of a scenario to the manifest file of the current process.
+
+    Each process appends to its own manifest file, so no locking is needed when running parallel processes.
+
+    Parameters:
+    scenario_name (str): The name of the scenario.
+    status (str): The status of the scenario.
+    images (dict): A dictionary where the keys are the image filenames (without extension) and the values are the paths of the images written to disk.
+    captions (dict, optional): A dictionary where the keys are the image filenames (without extension) and the values are the captions for the images. Defaults to None.
+    hashes (dict, optional): A dictionary where the keys are the image filenames (without extension) and the values are the image hashes. Defaults to None.
+
+    Returns:
+    None
+    """
+    run_index_path = get_run_index_path()
+    if not run_index_path or not images:
+        return
+    logs_env = os.getenv('LOGS')
+    captions = captions or {}
+    hashes = hashes or {}
+    manifest = {
+        'scenario': scenario_name,
+        'status': status,
+        'time': time.time(),
+        'images': [
+            {
+                # Paths are relative to the LOGS folder, as the report can be moved to another location
+                'path': os.path.relpath(os.path.abspath(images[key]), logs_env).replace(os.sep, '/'),
+                'captions': [_decode_caption(caption) for caption in captions.get(key, [])],
+                'hash': str(hashes[key]) if hashes.get(key) is not None else None,
+            }
+            for key in sorted(images)
+        ],
+    }
+    if not os.path.isdir(run_index_path):
+        os.makedirs(run_index_path, exist_ok=True)
+    manifest_filename = os.path.join(run_index_path, 'manifest_%d.jsonl' % os.getpid())
+    # Each manifest is appended with a single write, as a single line
+    with open(manifest_filename, 'a') as manifest_file:
+        manifest_file.write(json.dumps(manifest) + '\n')
+
+
+def build_run_index(page_size=DEFAULT_PAGE_SIZE):
+    """
+    This function adds the manifests appended by all the processes to the paged run-level image index.
+
+    The index is built incrementally, as this function is called when each process finishes: only the manifests
+    appended since the index was last built are read, and only the last page of the index and the new pages are written.
+    When the `filelock` library is available, a lock ensures that parallel processes do not write the index at the same
+    time. Each page is written atomically, so a partially written page is never visible.
+
+    Parameters:
+    page_size (int, optional): The number of images shown in each page. Defaults to 500.
+
+    Returns:
+    str: The path of the first page of the index, or None if there were no images to index.
+    """
+    run_index_path = get_run_index_path()
+    if not run_index_path or not os.path.isdir(run_index_path):
+        return None
+    if HAS_FILELOCK:
+        try:
+            with FileLock(run_index_path + '.lock', timeout=30):
+                return _write_run_index(run_index_path, page_size)
+        except Exception as exception:  # pylint: disable=broad-exception-caught
+            logging.error('[behavex-images] The run-level image index could not be created: %s' % str(exception))
+            return None
+    return _write_run_index(run_index_path, page_size)
+
+
+def _write_run_index(run_index_path, page_size):
+    """
+    Adds the manifests appended since the index was last built to the index, rewriting its last page and writing the
+    new pages. The pages before the last one are full, and their links (to the first, previous and next pages) do not
+    change, so they are not written again.
+    """
+    index_state = _read_index_state(run_index_path, page_size)
+    manifests = _read_new_manifests(run_index_path, index_state['offsets'])
+    if not manifests:
+        return os.path.join(run_index_path, _get_page_filename(1)) if index_state['pages'] else None
+    # The last page is completed with the new images, and the following pages are created when it is full
+    first_page_number = max(index_state['pages'], 1)
+    current_page = index_state['last_page']
+    images_in_page = sum(len(images) for _, images in current_page)
+    pages = []
+    for manifest in manifests:
+        current_page.append(({'scenario': manifest['scenario'], 'status': manifest['status']}, []))
+        for image in manifest['images']:
+            if images_in_page == page_size:
+                pages.append(current_page)
+                current_page = [(current_page[-1][0], [])]
+                images_in_page = 0
+            current_page[-1][1].append(image)
+            images_in_page += 1
+    pages.append(current_page)
+    last_page_number = first_page_number + len(pages) - 1
+    logs_env = os.path.dirname(run_index_path)
+    for page_number, page in enumerate(pages, first_page_number):
+        navigation = _render_navigation(page_number, page_number < last_page_number)
+        entries = [navigation]
+        for scenario, images in page:
+            if not images:
+                continue
+            entries.append(_SCENARIO_HEADING.substitute(
+                scenario=gallery.escape_text(scenario['scenario']),
+                status=gallery.escape_text(scenario['status'] or '')
+            ))
+            for image in images:
+                captions = image['captions']
+                if image.get('hash'):
+                    captions = captions + ['hash: %s<br>' % image['hash']]
+                entries.append(gallery.render_gallery_entry(run_index_path, os.path.join(logs_env, image['path']), captions))
+        entries.append(navigation)
+        gallery.write_gallery(run_index_path, 'BehaveX images', entries, filename=_get_page_filename(page_number))
+    index_state.update({'pages': last_page_number, 'last_page': current_page})
+    file_utils.write_file_atomically(os.path.join(run_index_path, _INDEX_STATE_FILENAME),
+                                     json.dumps(index_state).encode('utf-8'))
+    return os.path.join(run_index_path, _get_page_filename(1))
+
+
+def _read_index_state(run_index_path, page_size):
+    """
+    Returns the state of the index when it was last built: the offset up to which each manifest file was read, the
+    number of pages, and the scenarios and images of the last page. If there is no valid state, or the page size
+    changed, the pages of the index are removed, so the index is built again from all the manifests.
+    """
+    try:
+        with open(os.path.join(run_index_path, _INDEX_STATE_FILENAME)) as index_state_file:
+            index_state = json.load(index_state_file)
+        if index_state['page_size'] == page_size:
+            return index_state
+    except (IOError, OSError, ValueError, KeyError, TypeError):
+        pass
+    for page_filename in glob.glob(os.path.join(run_index_path, 'index*.html')):
+        os.remove(page_filename)
+    return {'page_size': page_size, 'offsets': {}, 'pages': 0, 'last_page': []}
+
+
+def _read_new_manifests(run_index_path, offsets):
+    """
+    Returns the manifests appended by all the processes since the given offsets (by manifest filename), sorted by the
+    time the scenarios finished, and updates the offsets. A line still being appended is read on the next build.
+    """
+    manifests = []
+    for manifest_filename in glob.glob(os.path.join(run_index_path, _MANIFEST_PATTERN)):
+        manifest_offset = offsets.get(os.path.basename(manifest_filename), 0)
+        with open(manifest_filename, 'rb') as manifest_file:
+            manifest_file.seek(manifest_offset)
+            appended_data = manifest_file.read()
+        complete_data = appended_data[:appended_data.rfind(b'\n') + 1]
+        offsets[os.path.basename(manifest_filename)] = manifest_offset + len(complete_data)
+        for line in complete_data.splitlines():
+            try:
+                manifests.append(json.loads(line.decode('utf-8')))
+            except ValueError:
+                # A line could be incomplete, if the process writing it was interrupted
+                continue
+    manifests.sort(key=lambda manifest: manifest.get('time', 0))
+    return manifests
+
+
+def _render_navigation(page_number, has_next_page):
+    """Returns the links to the first, previous and next pages of the index, or an empty string if there is a single page"""
+    if page_number == 1 and not has_next_page:
+        return ''
+    links = []
+    if page_number > 2:
+        links.append(_PAGE_LINK.substitute(href=_get_page_filename(1), page=1))
+    if page_number > 3:
+        links.append('&hellip;')
+    if page_number > 1:
+        links.append(_PAGE_LINK.substitute(href=_get_page_filename(page_number - 1), page=page_number - 1))
+    links.append(_CURRENT_PAGE.substitute(page=page_number))
+    if has_next_page:
+        links.append(_PAGE_LINK.substitute(href=_get_page_filename(page_number + 1), page=page_number + 1))
+    return _PAGES_NAVIGATION.substitute(links=' '.join(links))
+
+
+def _get_page_filename(page_number):
+    """Returns the filename of a page of the index"""
+    return 'index.html' if page_number == 1 else 'index_%d.html' % page_number
+
+
+def _decode_caption(caption):
+    """Returns the caption as text, to be stored in the manifest"""
+    try:
+        return caption.decode('utf8')
+    except AttributeError:
+        return str(caption)
@@ -0,0 +1,342 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of the behavex-images attachment pipeline.
+
+Usage:
+    python benchmarks/bench_attachments.py [--quick] [--output results.json] [--compare baseline.json]
+
+Each benchmark is repeated several times, and the minimum and median time per operation are reported.
+The results are written as JSON, so they can be compared against a previous run (e.g. the last release)
+to detect regressions.
+"""
+
+import argparse
+import json
+import logging
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import types
+from io import BytesIO
+
+# The benchmarks measure the behavex-images package of this repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import behave  # noqa: E402
+import PIL  # noqa: E402
+import synthetic_images  # noqa: E402
+from behave.runner import ModelRunner  # noqa: E402
+from PIL import Image  # noqa: E402
+
+from behavex_images import extend_environment, image_attachments  # noqa: E402
+from behavex_images.utils import image_hash, report_utils  # noqa: E402
+
+BEHAVE_VERSION = tuple(map(int, getattr(behave, '__version__', '1.2.6').split('.')[:2]))
+
+# Relative slowdown (compared with the baseline) reported as a regression, unless configured otherwise
+DEFAULT_REGRESSION_THRESHOLD = 0.10
+
+# Script run in a new process to measure the time to import behavex-images and to extend the behave hooks
+IMPORT_SCRIPT = """
+import json, sys, time
+started = time.perf_counter()
+from behavex_images import extend_environment
+imported = time.perf_counter()
+extend_environment.hooks_already_set = False
+extend_environment.extend_behave_hooks()
+print(json.dumps({
+    'extend_environment': imported - started,
+    'extend_behave_hooks': time.perf_counter() - imported,
+    'pillow_imported': 'PIL.Image' in sys.modules,
+}))
+"""
+
+# Extensions of the image files attached with attach_image_file
+FILE_EXTENSIONS = {'PNG': '.png', 'JPEG': '.jpg'}
+
+
+class StandInRunner(object):
+    """Runner with no user hooks, so the patched run_hook only measures the behavex-images hooks"""
+
+    def __init__(self, context):
+        self.context = context
+        self.hooks = {}
+
+    def should_run_hook(self, hook_name):  # pylint: disable=unused-argument
+        return False
+
+
+def run_hook(runner, name, hook_target=None):
+    """Calls the patched ModelRunner.run_hook as behave would, for the installed behave version"""
+    if BEHAVE_VERSION >= (1, 3):
+        ModelRunner.run_hook(runner, name, hook_target)
+    elif hook_target is None:
+        ModelRunner.run_hook(runner, name, runner.context)
+    else:
+        ModelRunner.run_hook(runner, name, runner.context, hook_target)
+
+
+def new_context(logs_folder, name):
+    """Returns a stand-in context with the scenario folder created"""
+    context = types.SimpleNamespace(config=types.SimpleNamespace())
+    context.log_path = os.path.join(logs_folder, name)
+    os.makedirs(context.log_path, exist_ok=True)
+    return context
+
+
+def start_scenario(context, name, condition=image_attachments.AttachmentsCondition.ALWAYS):
+    """Runs the hooks that start a scenario, and the first step"""
+    extend_environment.before_all(context)
+    image_attachments.set_attachments_condition(context, condition)
+    extend_environment.before_scenario(context, types.SimpleNamespace(name=name))
+    extend_environment.before_step(context, types.SimpleNamespace(name='step', filename='bench.feature', line=1))
+
+
+def bench_attach_image_binary(images, logs_folder):
+    context = new_context(logs_folder, 'attach_binary')
+    start_scenario(context, 'attach_binary')
+    started = time.perf_counter()
+    for image in images:
+        image_attachments.attach_image_binary(context, image)
+    elapsed = time.perf_counter() - started
+    extend_environment.after_scenario(context, types.SimpleNamespace(name='attach_binary', status='passed'))
+    return elapsed, len(images)
+
+
+def bench_attach_image_file(image_files, logs_folder):
+    context = new_context(logs_folder, 'attach_file')
+    start_scenario(context, 'attach_file')
+    started = time.perf_counter()
+    for image_file in image_files:
+        image_attachments.attach_image_file(context, image_file)
+    elapsed = time.perf_counter() - started
+    extend_environment.after_scenario(context, types.SimpleNamespace(name='attach_file', status='passed'))
+    return elapsed, len(image_files)
+
+
+def bench_dhash(images, logs_folder):  # pylint: disable=unused-argument
+    started = time.perf_counter()
+    for image in images:
+        with BytesIO(image) as image_file:
+            image_hash.dhash(Image.open(image_file))
+    return time.perf_counter() - started, len(images)
+
+
+def bench_hash_distance(hashes, logs_folder, number=100000):  # pylint: disable=unused-argument
+    started = time.perf_counter()
+    for index in range(number):
+        _ = hashes[index % len(hashes)] - hashes[(index + 1) % len(hashes)]
+    return time.perf_counter() - started, number
+
+
+def prepare_scenario(images, logs_folder, name):
+    """Returns a context with the images attached, ready to be dumped to disk"""
+    context = new_context(logs_folder, name)
+    start_scenario(context, name)
+    for index, image in enumerate(images):
+        context.bhximgs_current_step_line = index + 1
+        image_attachments.attach_image_binary(context, image)
+    image_attachments.process_pending_images(context)
+    return context
+
+
+def bench_dump_images_to_disk(images, logs_folder):
+    context = prepare_scenario(images, logs_folder, 'dump')
+    started = time.perf_counter()
+    dump_result = report_utils.dump_images_to_disk(context)
+    elapsed = time.perf_counter() - started
+    extend_environment.close_log_handler(context.bhximgs_step_log_handler)
+    return elapsed, len(dump_result.written)
+
+
+def bench_create_gallery(images, logs_folder):
+    context = prepare_scenario(images, logs_folder, 'gallery')
+    dump_result = report_utils.dump_images_to_disk(context)
+    captions = report_utils.get_captions(context)
+    started = time.perf_counter()
+    report_utils.create_gallery(context.log_path, title='gallery', captions=captions, images=dump_result.written)
+    elapsed = time.perf_counter() - started
+    extend_environment.close_log_handler(context.bhximgs_step_log_handler)
+    return elapsed, 1
+
+
+def bench_run_hook_per_step(logs_folder, steps=2000):
+    """Measures the hooks overhead of a step that does not attach images"""
+    context = new_context(logs_folder, 'run_hook')
+    runner = StandInRunner(context)
+    run_hook(runner, 'before_all')
+    scenario = types.SimpleNamespace(name='run_hook', status='passed')
+    run_hook(runner, 'before_scenario', scenario)
+    step_objects = [types.SimpleNamespace(name='step', step_type='given', filename='bench.feature', line=index)
+                    for index in range(steps)]
+    started = time.perf_counter()
+    for step in step_objects:
+        run_hook(runner, 'before_step', step)
+        run_hook(runner, 'after_step', step)
+    elapsed = time.perf_counter() - started
+    run_hook(runner, 'after_scenario', scenario)
+    return elapsed, steps
+
+
+def bench_run_hook_scenario(images, logs_folder, status='failed'):
+    """Measures a whole simulated scenario, attaching one image per step, through the patched run_hook"""
+    context = new_context(logs_folder, 'run_hook_' + status)
+    runner = StandInRunner(context)
+    run_hook(runner, 'before_all')
+    image_attachments.set_attachments_condition(context, image_attachments.AttachmentsCondition.ONLY_ON_FAILURE)
+    scenario = types.SimpleNamespace(name='run_hook_' + status, status=status)
+    started = time.perf_counter()
+    run_hook(runner, 'before_scenario', scenario)
+    for index, image in enumerate(images):
+        step = types.SimpleNamespace(name='step', step_type='given', filename='bench.feature', line=index + 1)
+        run_hook(runner, 'before_step', step)
+        image_attachments.attach_image_binary(context, image)
+        run_hook(runner, 'after_step', step)
+    run_hook(runner, 'after_scenario', scenario)
+    return time.perf_counter() - started, len(images)
+
+
+def bench_import(logs_folder, measured='extend_environment'):  # pylint: disable=unused-argument
+    """Measures importing behavex-images (or extending the behave hooks) in a new process"""
+    repository_folder = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    output = subprocess.check_output([sys.executable, '-c', IMPORT_SCRIPT], cwd=repository_folder)
+    import_timings = json.loads(output.decode('utf-8').strip().splitlines()[-1])
+    if import_timings['pillow_imported']:
+        logging.error('Pillow was imported by behavex-images before attaching any image')
+    return import_timings[measured], 1
+
+
+def measure(benchmark, repeat):
+    """Runs a benchmark several times, returning the minimum and median time per operation"""
+    timings = []
+    operations = 0
+    for _ in range(repeat):
+        logs_folder = tempfile.mkdtemp(prefix='bhximgs-bench-')
+        os.environ['LOGS'] = logs_folder
+        try:
+            elapsed, operations = benchmark(logs_folder)
+        finally:
+            shutil.rmtree(logs_folder, ignore_errors=True)
+        timings.append(elapsed / max(operations, 1))
+    return {
+        'operations': operations,
+        'repeat': repeat,
+        'min_us': min(timings) * 1000000,
+        'median_us': statistics.median(timings) * 1000000,
+    }
+
+
+def get_benchmarks(quick):
+    """Returns the benchmarks to run, as a dictionary of names and functions receiving the LOGS folder"""
+    resolutions = ['small'] if quick else list(synthetic_images.RESOLUTIONS)
+    sequence_length = 5 if quick else 20
+    images_folder = tempfile.mkdtemp(prefix='bhximgs-bench-images-')
+    benchmarks = {}
+    for resolution in resolutions:
+        size = synthetic_images.RESOLUTIONS[resolution]
+        for image_format in synthetic_images.FORMATS:
+            distinct_images = synthetic_images.create_sequence('distinct', size, image_format, sequence_length)
+            suffix = '%s.%s' % (resolution, image_format.lower())
+            benchmarks['dhash.' + suffix] = _bind(bench_dhash, distinct_images)
+            for sequence in synthetic_images.SEQUENCES:
+                images = distinct_images if sequence == 'distinct' else \
+                    synthetic_images.create_sequence(sequence, size, image_format, sequence_length)
+                name = '%s.%s' % (sequence, suffix)
+                benchmarks['attach_image_binary.' + name] = _bind(bench_attach_image_binary, images)
+                image_files = []
+                for index, image in enumerate(images):
+                    image_file = os.path.join(images_folder, '%s_%d%s' % (name, index, FILE_EXTENSIONS[image_format]))
+                    with open(image_file, 'wb') as output_file:
+                        output_file.write(image)
+                    image_files.append(image_file)
+                benchmarks['attach_image_file.' + name] = _bind(bench_attach_image_file, image_files)
+            benchmarks['dump_images_to_disk.' + suffix] = _bind(bench_dump_images_to_disk, distinct_images)
+            benchmarks['create_gallery.' + suffix] = _bind(bench_create_gallery, distinct_images)
+            benchmarks['run_hook.scenario_failed.' + suffix] = _bind(bench_run_hook_scenario, distinct_images)
+            benchmarks['run_hook.scenario_passed.' + suffix] = \
+                _bind(bench_run_hook_scenario, distinct_images, status='passed')
+    small_images = synthetic_images.create_sequence('distinct', synthetic_images.RESOLUTIONS['small'], 'PNG', 8)
+    hashes = [image_hash.dhash(Image.open(BytesIO(image))) for image in small_images]
+    benchmarks['ImageHash.__sub__'] = _bind(bench_hash_distance, hashes)
+    benchmarks['run_hook.step'] = bench_run_hook_per_step
+    benchmarks['import.extend_environment'] = bench_import
+    benchmarks['import.extend_behave_hooks'] = lambda logs_folder: bench_import(logs_folder, 'extend_behave_hooks')
+    return benchmarks, images_folder
+
+
+def compare(results, baseline, threshold):
+    """Prints the results compared with a baseline, and returns the names of the benchmarks that regressed"""
+    regressions = []
+    print('%-60s %12s %12s %8s' % ('benchmark', 'baseline_us', 'median_us', 'change'))
+    for name in sorted(results['benchmarks']):
+        median = results['benchmarks'][name]['median_us']
+        baseline_benchmark = baseline.get('benchmarks', {}).get(name)
+        if not baseline_benchmark:
+            print('%-60s %12s %12.1f %8s' % (name, '-', median, 'new'))
+            continue
+        change = median / baseline_benchmark['median_us'] - 1
+        flag = ' <-- regression' if change > threshold else ''
+        print('%-60s %12.1f %12.1f %+7.1f%%%s' % (name, baseline_benchmark['median_us'], median, change * 100, flag))
+        if flag:
+            regressions.append(name)
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks of the behavex-images attachment pipeline.')
+    parser.add_argument('--quick', action='store_true', help='run a reduced set of benchmarks')
+    parser.add_argument('--repeat', type=int, default=5, help='number of times each benchmark is repeated')
+    parser.add_argument('--filter', default='', help='only run the benchmarks whose name contains this text')
+    parser.add_argument('--output', help='JSON file where the results are written')
+    parser.add_argument('--compare', help='JSON file with the results of a previous run, to compare with')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_REGRESSION_THRESHOLD,
+                        help='relative slowdown reported as a regression (default: 0.10)')
+    args = parser.parse_args(argv)
+
+    # The log records captured as image captions are not relevant for the benchmarks
+    logging.getLogger().setLevel(logging.ERROR)
+    benchmarks, images_folder = get_benchmarks(args.quick)
+    results = {
+        'environment': {
+            'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'platform': platform.platform(),
+            'pillow': PIL.__version__,
+            'behave': getattr(behave, '__version__', ''),
+        },
+        'benchmarks': {},
+    }
+    try:
+        for name in sorted(benchmarks):
+            if args.filter not in name:
+                continue
+            results['benchmarks'][name] = measure(benchmarks[name], args.repeat)
+            if not args.compare:
+                print('%-60s %12.1f us' % (name, results['benchmarks'][name]['median_us']))
+    finally:
+        shutil.rmtree(images_folder, ignore_errors=True)
+        extend_environment.after_all(None)
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+        if compare(results, baseline, args.threshold):
+            return 1
+    return 0
+
+
+def _bind(benchmark, *args, **kwargs):
+    """Returns the benchmark as a function receiving the LOGS folder"""
+    return lambda logs_folder: benchmark(*args, logs_folder=logs_folder, **kwargs)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
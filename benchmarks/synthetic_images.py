@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""
+Synthetic screenshots used by the behavex-images benchmarks.
+
+The images are generated from a fixed seed, so every run measures exactly the same binaries.
+"""
+
+import random
+from io import BytesIO
+
+from PIL import Image, ImageDraw
+
+# Resolutions of the generated screenshots
+RESOLUTIONS = {
+    'small': (800, 600),
+    'hd': (1366, 768),
+    'fhd': (1920, 1080),
+}
+
+# Formats of the generated screenshots
+FORMATS = ('PNG', 'JPEG')
+
+# Sequences of screenshots: the same screenshot, screenshots with a small change each, or different screenshots
+SEQUENCES = ('identical', 'near_identical', 'distinct')
+
+
+def create_screenshot(size, seed, changed_region=None):
+    """
+    Creates an image resembling a screenshot of a web page: a header, a sidebar, blocks of content and lines of text.
+
+    Parameters:
+    size (tuple): The width and height of the screenshot.
+    seed (int): The seed of the layout and colors of the screenshot.
+    changed_region (int, optional): When provided, a small region (e.g. a counter or a cursor) is drawn at a
+                                    position depending on this value, to create near-identical screenshots.
+
+    Returns:
+    Image: The screenshot.
+    """
+    rand = random.Random(seed)
+    width, height = size
+    img = Image.new('RGB', size, (250, 250, 250))
+    draw = ImageDraw.Draw(img)
+    header_height = height // 12
+    sidebar_width = width // 6
+    draw.rectangle((0, 0, width, header_height), fill=_random_color(rand))
+    draw.rectangle((0, header_height, sidebar_width, height), fill=_random_color(rand, 200))
+    y = header_height + 20
+    while y < height - 40:
+        block_height = rand.randint(40, max(41, height // 5))
+        x = sidebar_width + 20
+        while x < width - 60:
+            block_width = rand.randint(80, max(81, width // 3))
+            draw.rectangle((x, y, min(x + block_width, width - 20), min(y + block_height, height - 20)),
+                           fill=_random_color(rand, 160), outline=(120, 120, 120))
+            # Lines of text are simulated with short dark segments
+            for text_y in range(y + 8, min(y + block_height, height - 20) - 6, 12):
+                text_width = rand.randint(block_width // 4, max(block_width // 4 + 1, block_width - 16))
+                draw.line((x + 8, text_y, x + 8 + text_width, text_y), fill=(40, 40, 40), width=2)
+            x += block_width + 20
+        y += block_height + 20
+    if changed_region is not None:
+        offset = (changed_region * 37) % max(1, width - sidebar_width - 80)
+        draw.rectangle((sidebar_width + offset, header_height // 4, sidebar_width + offset + 60, header_height * 3 // 4),
+                       fill=(255, 255, 255))
+        draw.text((sidebar_width + offset + 4, header_height // 4), str(changed_region), fill=(0, 0, 0))
+    return img
+
+
+def encode_image(img, image_format):
+    """Returns the binary of an image, encoded in the given format"""
+    binary_data = BytesIO()
+    if image_format == 'JPEG':
+        img.save(binary_data, format='JPEG', quality=85)
+    else:
+        img.save(binary_data, format=image_format)
+    return binary_data.getvalue()
+
+
+def create_sequence(sequence, size, image_format, length):
+    """
+    Creates a sequence of screenshot binaries.
+
+    Parameters:
+    sequence (str): The kind of sequence ('identical', 'near_identical' or 'distinct').
+    size (tuple): The width and height of the screenshots.
+    image_format (str): The format of the screenshots ('PNG' or 'JPEG').
+    length (int): The number of screenshots in the sequence.
+
+    Returns:
+    list: The screenshot binaries.
+    """
+    if sequence == 'identical':
+        return [encode_image(create_screenshot(size, 0), image_format)] * length
+    if sequence == 'near_identical':
+        return [encode_image(create_screenshot(size, 0, changed_region=index), image_format) for index in range(length)]
+    return [encode_image(create_screenshot(size, index), image_format) for index in range(length)]
+
+
+def _random_color(rand, minimum=0):
+    return rand.randint(minimum, 255), rand.randint(minimum, 255), rand.randint(minimum, 255)
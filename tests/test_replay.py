@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""
+BehaveX - BDD testing library based on Behave
+"""
+# pylint: disable=W0403
+
+# __future__ has been added in order to maintain compatibility
+from __future__ import absolute_import, print_function
+
+import json
+import os
+from io import BytesIO
+
+import pytest
+from PIL import Image, ImageDraw, features
+
+from behavex_images.utils import replay
+
+
+def _get_image_binary(size, box, color):
+    """Returns a PNG image with a white background and a filled rectangle"""
+    image = Image.new('RGB', size, (255, 255, 255))
+    ImageDraw.Draw(image).rectangle(box, fill=color)
+    image_binary_data = BytesIO()
+    image.save(image_binary_data, format='PNG')
+    return image_binary_data.getvalue()
+
+
+def _get_expected_frame(image_binary, canvas_size):
+    """Returns the image drawn on a white canvas of the given size, as shown in the replay"""
+    canvas = Image.new('RGB', canvas_size, (255, 255, 255))
+    with Image.open(BytesIO(image_binary)) as image:
+        canvas.paste(image.convert('RGB'), (0, 0))
+    return canvas
+
+
+IMAGE_BINARIES = [
+    _get_image_binary((160, 120), (10, 10, 40, 40), (255, 0, 0)),
+    _get_image_binary((160, 120), (11, 10, 41, 40), (255, 0, 0)),
+    # An unchanged frame
+    _get_image_binary((160, 120), (11, 10, 41, 40), (255, 0, 0)),
+    # A smaller frame, drawn on the top left corner of the canvas
+    _get_image_binary((90, 70), (0, 0, 89, 69), (0, 0, 255)),
+    _get_image_binary((160, 120), (100, 80, 159, 119), (0, 128, 0)),
+]
+
+
+@pytest.mark.parametrize('replay_format', [
+    replay.ReplayFormat.APNG,
+    pytest.param(replay.ReplayFormat.WEBP,
+                 marks=pytest.mark.skipif(not features.check('webp'), reason='WebP is not supported by Pillow')),
+])
+def test_write_replay_round_trip(tmp_path, replay_format):
+    frames = [(str(index), lambda image_binary=image_binary: image_binary, ['caption %d' % index], None)
+              for index, image_binary in enumerate(IMAGE_BINARIES)]
+
+    replay_path = replay.write_replay(str(tmp_path), 'Scenario', frames, replay_format, frame_duration=250,
+                                      with_gallery=False)
+
+    assert replay_path == replay.get_replay_path(str(tmp_path), replay_format)
+    with Image.open(replay_path) as replay_image:
+        assert replay_image.size == (160, 120)
+        # The encoder can merge an unchanged frame with the previous one, so the frames are compared by their time
+        shown_frames = []
+        for frame_index in range(replay_image.n_frames):
+            replay_image.seek(frame_index)
+            # The frame is converted first, as its duration is only known once it is loaded
+            shown_frame = replay_image.convert('RGB').tobytes()
+            shown_frames.extend([shown_frame] * int(round(replay_image.info['duration'] / 250.0)))
+    assert len(shown_frames) == len(IMAGE_BINARIES)
+    for image_binary, shown_frame in zip(IMAGE_BINARIES, shown_frames):
+        assert shown_frame == _get_expected_frame(image_binary, (160, 120)).tobytes()
+    with open(os.path.join(str(tmp_path), replay.REPLAY_METADATA_FILENAME)) as metadata_file:
+        replay_metadata = json.load(metadata_file)
+    assert [frame['start'] for frame in replay_metadata['frames']] == [0, 250, 500, 750, 1000]
+    assert replay_metadata['frames'][3]['size'] == [90, 70]